@@ -54,10 +54,10 @@ class App(pyacc.AccCommandLineApp):
 
         if self.args.agent_ids:
             # Create a list of Agent objects initialized with the agent id.
-            # The data will be fetched (and cached) from the Config Server when the object
-            # is first queried (e.g. "agent["agentName"]).  Further queries on the object
-            # will not re-fetch it from the server.
-            agents = self.acc.agents_many(self.args.agent_ids)
+            # The data for all of them is fetched (and cached) from the Config Server up front,
+            # in as few requests as possible.  Further queries on the objects
+            # (e.g. "agent["agentName"]) will not re-fetch them from the server.
+            agents = self.acc.agents_many(self.args.agent_ids, hydrate=True)
         else:
             request_params = {}
 
@@ -71,8 +71,10 @@ class App(pyacc.AccCommandLineApp):
             if sort_order:
                 request_params["sort"] = sort_order
 
-            # This will fetch a filtered list of agents a page a time when we iterate over it
-            agents = self.acc.agents(**request_params)
+            # This will fetch a filtered list of agents a page a time when we iterate over it,
+            # only keeping the fields we use
+            agents = self.acc.agents(fields=["packageDetails", "serverName", "processName", "agentName"],
+                                     **request_params)
 
         if not self.args.ood and not self.args.latest and not self.args.no_package:
             self.args.ood = self.args.latest = self.args.no_package = True
@@ -11,8 +11,8 @@ import os
 import sys
 import tarfile
 import re
-
-from distutils.version import LooseVersion
+import multiprocessing
+import collections
 
 import pyacc
 
@@ -36,7 +36,36 @@ class NoAvailableBundleMappingException(BundleMappingException):
     pass
 
 
-class App(pyacc.AccCommandLineApp):
+# The archive scanners are module level functions so they can be run in a multiprocessing.Pool
+
+def scan_bundle_archive(filename):
+    """List the files in a bundle archive"""
+    with tarfile.open(filename) as btf:
+        return [ti.name for ti in btf.getmembers() if not ti.isdir() and not ti.name.startswith("metadata/")]
+
+
+def scan_agent_archive(filename):
+    """
+    List the files in an agent archive and read any .profile files in it.
+    Returns (list of file names, dictionary of profile file name -> content)
+    """
+    files = []
+    profiles = {}
+
+    with tarfile.open(filename) as atf:
+        for ti in atf:
+            if ti.isdir():
+                continue
+
+            files.append(ti.name)
+
+            if ti.name.endswith(".profile"):
+                profiles[ti.name] = atf.extractfile(ti).read()
+
+    return files, profiles
+
+
+class App(pyacc.PackageBatchMixin, pyacc.AccCommandLineApp):
 
     appservers = ["other", "ctg-server", "glassfish", "interstage", "jboss", "tomcat", "weblogic", "websphere"]
     val_re = re.compile("^([#]?)(.*)=(.*)")
@@ -62,35 +91,104 @@ class App(pyacc.AccCommandLineApp):
 
         self.parser.add_argument('-d', '--download', action='store_true', help="Download package after creating it")
 
+        self.parser.add_argument('--processes', action='store', type=int, default=multiprocessing.cpu_count(),
+                                 help="number of processes used to scan archives (default is the number of cpus)")
+
+        self.parser.add_argument('--batch', action='store', metavar="DIR_OR_MANIFEST",
+                                 help="create packages for every agent archive in a directory, or listed in a CSV manifest "
+                                      "with a file column and optional name, os, appserver and agent_version columns")
+        self.parser.add_argument('--summary', action='store', default="packages.csv",
+                                 help="CSV file listing the packages created by --batch (default packages.csv)")
 
         self.parser.add_argument('agent', metavar='AGENT', nargs='*', type=str, help='Agent Package')
 
     def fetch_bundles(self):
-        bundle_files = []
+        bundles = []
         for bundle in self.acc.bundles(size=200):
             print("\t%s" % bundle["displayName"])
             if self.args.verbose:
                 bundle["id"]
                 print(bundle)
 
-            bundle.filename = bundle.download(directory="bundle_temp")
-            bundle_files.append(bundle)
+            bundles.append(bundle)
+
+        if not os.path.exists("bundle_temp"):
+            os.mkdir("bundle_temp")
+
+        # Download the bundles several at a time
+        bundle_files = []
+        for bundle, filename, e in self.acc.download_many(bundles, directory="bundle_temp"):
+            if e:
+                raise e
+
+            bundle_files.append((bundle, filename))
         return bundle_files
 
+    def bundle_index_path(self):
+        """
+        The persistent bundle index maps bundle id -> {"signature": Bundle.cache_key(), "files": [...]}
+        so that only new or changed bundle archives need to be opened.  The signature identifies the
+        bundle's content rather than the downloaded file, which is new each time bundle_temp is filled.
+        """
+        return self.acc_env.cache_path("%s-bundle-file-index.json" % (self.acc_env.profile or "default"))
+
+    def scan_archives(self, scan, filenames):
+        """Return [scan(filename) for filename in filenames], spreading the work over several processes"""
+        processes = min(self.args.processes, len(filenames))
+
+        if processes <= 1:
+            return [scan(filename) for filename in filenames]
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(scan, filenames)
+        finally:
+            pool.close()
+            pool.join()
+
     def index_bundles(self, bundle_files):
-        filename_map = {}
-        for bundle in bundle_files:
-            print("\n\t%s:%s (%s)" % (bundle["name"], bundle["version"], bundle.filename))
-            btf = tarfile.open(bundle.filename)
-            for ti in btf.getmembers():
-                if ti.isdir() or ti.name.startswith("metadata/"):
-                    pass
-                else:
-                    print("\t\t%s" % ti.name)
-                    entries = filename_map.setdefault(ti.name, [])
-                    entries.append(bundle)
-            btf.close()
-        return filename_map
+        """Index the bundles of bundle_files, (bundle, downloaded archive) pairs from fetch_bundles"""
+        bundle_index = pyacc.BundleIndex()
+
+        index = pyacc.read_json_file(self.bundle_index_path())
+        new_index = {}
+
+        signatures = {}
+        changed = []
+
+        filenames = dict((bundle.item_id, filename) for bundle, filename in bundle_files)
+
+        for bundle, filename in bundle_files:
+            signatures[bundle.item_id] = bundle.cache_key()
+            entry = index.get(str(bundle.item_id))
+
+            if not entry or entry["signature"] != signatures[bundle.item_id]:
+                changed.append(bundle)
+
+        # Open the new or changed bundle archives in parallel
+        scanned = dict(zip([bundle.item_id for bundle in changed],
+                           self.scan_archives(scan_bundle_archive, [filenames[bundle.item_id] for bundle in changed])))
+
+        for bundle, filename in bundle_files:
+            signature = signatures[bundle.item_id]
+
+            if bundle.item_id not in scanned:
+                print("\n\t%s:%s (%s, unchanged)" % (bundle["name"], bundle["version"], filename))
+                files = [name.encode("utf-8") for name in index[str(bundle.item_id)]["files"]]
+            else:
+                print("\n\t%s:%s (%s)" % (bundle["name"], bundle["version"], filename))
+                files = scanned[bundle.item_id]
+                for name in files:
+                    print("\t\t%s" % name)
+
+            new_index[str(bundle.item_id)] = {"signature": signature, "files": files}
+
+            bundle_index.add_files(bundle, files)
+
+        if new_index != index:
+            pyacc.write_json_file(self.bundle_index_path(), new_index)
+
+        return bundle_index
 
     def create_initial_package(self,
                                name="testBundle",
@@ -101,38 +199,31 @@ class App(pyacc.AccCommandLineApp):
                                agent_version="10.2",
                                comment="James is testing"):
 
-        # Create draft package. This enables us to get the required/compatible/includes list of bundles
-        new_package = self.acc.package_create(name=name,
-                                              os=os,
-                                              appserver=appserver,
-                                              em_host=em_host,
-                                              agent_version=agent_version,
-                                              process_display_name=process_display_name,
-                                              comment=comment,
-                                              draft="true")
+        # Create draft package. This enables us to get the required/compatible/includes list of bundles.
+        # The bundles and overrides we choose are added to the builder and sent in one go at the end.
+        builder = self.acc.package_builder(name=name,
+                                           os=os,
+                                           appserver=appserver,
+                                           em_host=em_host,
+                                           agent_version=agent_version,
+                                           process_display_name=process_display_name,
+                                           comment=comment)
+        new_package = builder.draft()
 
         print(new_package)
 
-        return new_package
+        return builder
 
-    def get_compatible_bundles(self, new_package):
+    def get_compatible_bundles(self, new_package, bundle_index):
 
         print("\nThese are the compatible bundles for the empty package:")
-        compatible_bundles = {}
+        bundles = []
         for bundle in new_package.compatible_bundles():
             print("\t%s:%s" % (bundle["name"], bundle["version"]))
+            bundles.append(bundle)
 
-            exist = compatible_bundles.get(bundle["name"])
-
-            if not exist:
-                compatible_bundles[bundle["name"]] = bundle
-            else:
-                # Select the higher version
-                if LooseVersion(bundle["version"]) > LooseVersion(exist["version"]):
-                    print("\t\tSelecting %s over %s" % (bundle["version"], exist["version"]))
-                    compatible_bundles[bundle["name"]] = bundle
-
-        return compatible_bundles
+        # Select the highest version of each bundle
+        return bundle_index.latest(bundles)
 
     def get_required_bundles(self, new_package):
 
@@ -144,16 +235,6 @@ class App(pyacc.AccCommandLineApp):
 
         return required_bundles
 
-    def archive_entries(self, archive):
-        """Loop over each file in an archive"""
-
-        with tarfile.open(archive) as atf:
-            for ti in atf:
-                if ti.isdir():
-                    pass
-                else:
-                    yield atf, ti
-
     def choose_bundle(self, entries, compatible_bundles, included_bundles):
 
         candidate = None
@@ -178,29 +259,27 @@ class App(pyacc.AccCommandLineApp):
 
         return candidate
 
-    def build_bundle_property_map(self, compatible_bundles):
+    def index_bundle_properties(self, bundle_index, compatible_bundles):
         # Now need to look at the profile and potentially add bundles for those.
         # Will also need to worry about override values.
 
-        property_bundle_map = {}
-
         print("\nReading properties for bundles:")
-        for bundle in compatible_bundles:
-            bundle.profile_property_map = {}
 
+        # Fetch the profiles several at a time, skipping any we have already indexed
+        new_bundles = [bundle for bundle in compatible_bundles if not bundle_index.has_properties(bundle)]
+        profiles = self.acc.bundle_profiles(new_bundles)
+
+        for bundle in new_bundles:
             print("\t%s:%s" % (bundle["name"], bundle["version"]))
-            profile = bundle.profile()
+            profile = profiles[bundle.item_id]
 
+            properties = {}
             for prop in profile["properties"] or []:
                 if not prop["hidden"]:
                     # print(prop)
-                    bundle_entry = property_bundle_map.setdefault(prop["name"], {})
-                    bundle_entry[bundle["name"]] = bundle
-
-                    # save the property map on the bundle
-                    bundle.profile_property_map[prop["name"]] = prop["value"] or ""
+                    properties[prop["name"]] = prop["value"] or ""
 
-        return property_bundle_map
+            bundle_index.add_properties(bundle, properties)
 
     def split_property(self, prop):
         prop_split = App.val_re.split(prop)
@@ -211,25 +290,39 @@ class App(pyacc.AccCommandLineApp):
         value = prop_split[3].strip()
         return hidden, name, value
 
-    def create_package_from_archive(self, agent_archive, filename_map):
+    def create_package_from_archive(self, agent_archive, archive_scan, bundle_index):
+        """
+        archive_scan is the (files, profiles) result of scan_agent_archive for agent_archive
+        """
 
         print("\nCreating empty package:")
 
         v2 = ".".join(self.args.agent_version.split(".")[0:2])
 
-        new_package = self.create_initial_package(name="testBundle",
-                                                  os=self.args.os,
-                                                  appserver=self.args.appserver,
-                                                  em_host=self.args.em_host,
-                                                  process_display_name="process display name",
-                                                  agent_version=v2,
-                                                  comment="Package derived from Agent archive " +
-                                                          os.path.basename(agent_archive))
-
-        compatible_bundles = self.get_compatible_bundles(new_package)
+        builder = self.create_initial_package(name="testBundle",
+                                              os=self.args.os,
+                                              appserver=self.args.appserver,
+                                              em_host=self.args.em_host,
+                                              process_display_name="process display name",
+                                              agent_version=v2,
+                                              comment="Package derived from Agent archive " +
+                                                      os.path.basename(agent_archive))
+
+        new_package = builder.package
+        compatible_bundles = self.get_compatible_bundles(new_package, bundle_index)
         included_bundles = self.get_required_bundles(new_package)
 
-        property_map = self.build_bundle_property_map(compatible_bundles.values())
+        self.index_bundle_properties(bundle_index, compatible_bundles.values())
+
+        self.plan_package(builder, agent_archive, archive_scan, bundle_index, compatible_bundles, included_bundles)
+
+        return builder.build()
+
+    def plan_package(self, builder, agent_archive, archive_scan, bundle_index, compatible_bundles, included_bundles):
+        """
+        Work out the bundles and overrides needed to reproduce agent_archive and add them to the builder.
+        included_bundles (bundle name -> Bundle) starts as the required bundles and is added to.
+        """
 
         property_bundles = {}
 
@@ -241,22 +334,21 @@ class App(pyacc.AccCommandLineApp):
 
         print("\nAnalyzing Agent Package: %s" % agent_archive)
         included_filename_map = {}
-        for atf, ti in self.archive_entries(agent_archive):
-            entries = filename_map.get(ti.name)
+        files, profiles = archive_scan
+        for filename in files:
+            entries = bundle_index.bundles("file", filename)
 
             if not entries:
-                print("\t%s : WARNING: No bundle mapping" % (ti.name))
+                print("\t%s : WARNING: No bundle mapping" % (filename))
             else:
-                print("\t%s : %s" % (ti.name, ["%s:%s" % (x["name"], x["version"]) for x in entries or []]))
-                included_filename_map[ti.name] = entries
+                print("\t%s : %s" % (filename, ["%s:%s" % (x["name"], x["version"]) for x in entries or []]))
+                included_filename_map[filename] = entries
 
-            if ti.name.endswith(".profile"):
-                print("\tFound profile:", ti.name)
+            if filename in profiles:
+                print("\tFound profile:", filename)
 
                 # parse that, look up the properties, etc
-                fileobj = atf.extractfile(ti)
-
-                for raw in fileobj:
+                for raw in profiles[filename].splitlines():
                     line = raw.strip()
                     if not line or line[0] == "#":
                         continue
@@ -269,15 +361,15 @@ class App(pyacc.AccCommandLineApp):
 
                             print("\t\tSearching for property: %s(=%s)" % (name, value))
 
-                            bundle_map = property_map.get(name)
+                            bundles = bundle_index.compatible("property", name, compatible_bundles)
 
-                            if not bundle_map:
+                            if not bundles:
                                 print("\t\t\tCould not find the property. This will be added as an override.")
                             else:
-                                print("\t\t\tFound property %s in %d bundles (%s)" % (name, len(bundle_map),
-                                    ["%s:%s" % (bundle["name"], bundle["version"]) for bundle in bundle_map.itervalues()]))
+                                print("\t\t\tFound property %s in %d bundles (%s)" % (name, len(bundles),
+                                    ["%s:%s" % (bundle["name"], bundle["version"]) for bundle in bundles]))
 
-                                property_bundles[name] = bundle_map.values()
+                                property_bundles[name] = bundles
                         else:
                             print("Skip hidden property %s" % name)
                     except IndexError as e:
@@ -290,8 +382,6 @@ class App(pyacc.AccCommandLineApp):
         property_to_bundle_map = self.resolve_bundles(["property", "properties"], property_bundles, compatible_bundles, included_bundles)
 
 
-        master = new_package["bundleOverrides"]
-
         override_count = 0
 
         # Need to check what the value in the profile and the bundle are. Is the are != then we need to create an override
@@ -305,109 +395,193 @@ class App(pyacc.AccCommandLineApp):
             if not bundle:
                 print("\tProperty %s is not fulfilled by any bundle, need to create an override to create the property" % (property))
 
-                overrides = master.setdefault("java-agent", {"preamble": None, "properties":[]})
-
-                prop_dic = {"description": None,
-                            "hidden": False,
-                            "name":  property,
-                            "value": value,
-                            "userKey": "+"}
-
-                overrides["properties"].append(prop_dic)
+                builder.add_override("java-agent", property, value, user_key="+")
 
                 override_count += 1
             else:
 
-                bundle_value = bundle.profile_property_map[property]
+                bundle_value = bundle_index.value(bundle, property)
 
                 print("\tProperty %s=%s is fulfilled by bundle %s:%s as %s=%s" % (property, value, bundle["name"], bundle["version"], property, bundle_value))
 
                 if value != bundle_value:
                     print("\t\tValues differ - will create an override: %s=%s\n" % (property, value))
 
-                    overrides = master.setdefault(bundle["name"], {"preamble": None, "properties":[]})
-
-                    prop_dic = {"description": None,
-                                "hidden": False,
-                                "name":  property,
-                                "value": value,
-                                "userKey": None}
-
-                    overrides["properties"].append(prop_dic)
+                    builder.add_override(bundle["name"], property, value)
 
                     override_count += 1
 
-        # Now add the bundles we selected to the package
-        self.add_bundles_to_package(new_package, included_bundles.values())
-
-        # Add the overrides TODO really want to do this as part of the same patch, rather than 2 patches
+        # Now add the bundles we selected and the overrides to the package, as a single patch
+        self.add_bundles_to_package(builder, included_bundles.values())
 
         if override_count > 0:
             print("\nAdding %d overrides" % override_count)
-            new_package.add_overrides(master)
-
-        return new_package
 
     def resolve_bundles(self, mapping_type, included_filename_map, compatible_bundles, included_bundles):
+        """
+        Map each file or property in included_filename_map (name -> bundles which provide it) to a bundle,
+        adding bundles to included_bundles as needed.
 
-        bundle_map = {}
-
-        # Add bundles from files
-        for i in range(len(included_filename_map)):
-
-            print("\nMapping %s to bundles, iteration %d" % (mapping_type[1], i))
-
-            # Keep looping trying to uniquely resolve the files of the agent archive to
-            # bundles.  If there is ambiguity for a certain file, we defer resolution and
-            # continue and try and resolve it afterwards whereby a bundle may have since been
-            # added which provides the uncertain file.
-            remaining = added = no_mapping = mapped = 0
-
-            for filename_or_property, entries in included_filename_map.iteritems():
-
-                try:
-                    candidate = self.choose_bundle(entries, compatible_bundles, included_bundles)
+        If there is ambiguity for a certain file we defer it, and only look at it again once a bundle
+        that could provide it has been added, rather than re-examining every file until the ambiguity
+        disappears.
+        """
 
-                    # Add the matched bundle to the included bundles list
-                    print("\tSelected bundle %s:%s for %s %s" % (candidate["name"], candidate["version"], mapping_type[0], filename_or_property))
-                    included_bundles[candidate["name"]] = candidate
+        bundle_map = {}
+        ambiguous = set()
+        no_mapping = set()
+        added = 0
+
+        # bundle name -> the files or properties which that bundle could provide
+        dependents = {}
+        for filename_or_property, entries in included_filename_map.iteritems():
+            for bundle in entries:
+                dependents.setdefault(bundle["name"], []).append(filename_or_property)
+
+        print("\nMapping %s to bundles" % mapping_type[1])
+
+        worklist = collections.deque(included_filename_map)
+        queued = set(worklist)
+
+        while worklist:
+            filename_or_property = worklist.popleft()
+            queued.discard(filename_or_property)
+
+            try:
+                candidate = self.choose_bundle(included_filename_map[filename_or_property], compatible_bundles, included_bundles)
+
+                # Add the matched bundle to the included bundles list
+                print("\tSelected bundle %s:%s for %s %s" % (candidate["name"], candidate["version"], mapping_type[0], filename_or_property))
+                included_bundles[candidate["name"]] = candidate
+
+                bundle_map[filename_or_property] = candidate
+                added += 1
+
+                # Anything unresolved that the new bundle could provide needs another look
+                for dependent in dependents[candidate["name"]]:
+                    if dependent not in bundle_map and dependent not in queued:
+                        worklist.append(dependent)
+                        queued.add(dependent)
+
+            except BundleAlreadyIncludedException as e:
+                bundle_map[filename_or_property] = e.bundle
+            except NoAvailableBundleMappingException:
+                no_mapping.add(filename_or_property)
+                continue
+            except AmbiguousBundleMappingException:
+                print("\tCould not resolve %s %s to a unique bundle (yet)" % (mapping_type[0], filename_or_property))
+                ambiguous.add(filename_or_property)
+                continue
+
+            ambiguous.discard(filename_or_property)
+            no_mapping.discard(filename_or_property)
+
+        print("%d %s successfully mapped to bundles (%d bundles added). %d remain unmapped" %
+              (len(bundle_map), mapping_type[1], added, len(no_mapping)))
+
+        if no_mapping:
+            print("\nThese %s have no compatible bundle:" % mapping_type[1])
+            for filename_or_property in sorted(no_mapping):
+                print("\t%s" % filename_or_property)
+
+        if ambiguous:
+            print("\nThese %s could not be resolved to a unique bundle:" % mapping_type[1])
+            for filename_or_property in sorted(ambiguous):
+                print("\t%s : %s" % (filename_or_property, ["%s:%s" % (x["name"], x["version"])
+                                                            for x in included_filename_map[filename_or_property]]))
+
+            raise AmbiguousBundleMappingException("Could not satisfactorily resolve %d %s to a bundle" %
+                                                  (len(ambiguous), mapping_type[1]))
 
-                    bundle_map[filename_or_property] = candidate
+        return bundle_map
 
-                    added += 1
+    def add_bundles_to_package(self, builder, bundles):
 
-                except BundleAlreadyIncludedException as e:
-                    bundle_map[filename_or_property] = e.bundle
-                    mapped += 1
-                except NoAvailableBundleMappingException:
-                    no_mapping += 1
-                except AmbiguousBundleMappingException:
-                    print("\tCould not resolve %s %s to a unique bundle (yet)" % (mapping_type[0], filename_or_property))
-                    remaining += 1
+        print("\nAdding %d bundles to package:" % len(bundles))
+        for bundle in bundles:
+            print("\t%s:%s" % (bundle["name"], bundle["version"]))
 
-            if remaining == 0:
-                # Nothing left to resolve
-                print("%d %s successfully mapped to bundles. %d remain unmapped" % (mapped, mapping_type[1], no_mapping))
-                break
+        builder.add_bundles([b["id"] for b in bundles])
 
-            if added == 0:
-                raise AmbiguousBundleMappingException("Could not satisfactorily resolve some %s to a bundle" % (mapping_type[1]))
+    def finish_package(self, builder):
+        """Create the package and optionally download it. Returns (package, filename or None)"""
+        new_package = builder.build()
 
-            print("Have %d %s that could not resolve to a bundle on iteration %d" % (remaining, mapping_type[1], i))
+        filename = None
+        if self.args.download:
+            filename = new_package.download(".", self.args.format, progress=False)
 
-        return bundle_map
+        return new_package, filename
 
-    def add_bundles_to_package(self, new_package, bundles):
+    def run_batch(self, inputs, archive_scans, bundle_index):
+        """
+        Create a package for each input. Inputs for the same os, appserver and agent version share a
+        single lookup of the compatible and required bundles, and the packages are created and
+        downloaded concurrently.
+        """
+        groups = collections.OrderedDict()
+        for entry, archive_scan in zip(inputs, archive_scans):
+            v2 = ".".join(entry["agent_version"].split(".")[0:2])
+            groups.setdefault((entry["os"], entry["appserver"], v2), []).append((entry, archive_scan))
+
+        results = []
+
+        for (os_name, appserver, agent_version), members in groups.iteritems():
+            print("\nCreating %d packages for %s %s %s" % (len(members), os_name, appserver, agent_version))
+
+            # A draft package tells us the compatible and required bundles for the whole group
+            probe = self.create_initial_package(name="agent2package",
+                                                os=os_name,
+                                                appserver=appserver,
+                                                em_host=self.args.em_host,
+                                                process_display_name="process display name",
+                                                agent_version=agent_version,
+                                                comment="Draft used to find compatible bundles").package
+            try:
+                compatible_bundles = self.get_compatible_bundles(probe, bundle_index)
+                required_bundles = self.get_required_bundles(probe)
+                # The overrides the server gives a new package, which a package created in one go misses out on
+                default_overrides = probe["bundleOverrides"] or {}
+            finally:
+                probe.delete()
+
+            self.index_bundle_properties(bundle_index, compatible_bundles.values())
+
+            for entry, archive_scan in members:
+                builder = self.acc.package_builder(name=entry["name"] or os.path.basename(entry["file"]).split(".")[0],
+                                                   os=os_name,
+                                                   appserver=appserver,
+                                                   em_host=self.args.em_host,
+                                                   agent_version=agent_version,
+                                                   process_display_name="process display name",
+                                                   comment="Package derived from Agent archive " +
+                                                           os.path.basename(entry["file"]))
+                builder.add_overrides(default_overrides)
+                try:
+                    self.plan_package(builder, entry["file"], archive_scan, bundle_index,
+                                      compatible_bundles, dict(required_bundles))
+                except BundleMappingException as e:
+                    results.append((entry, None, e))
+                    continue
 
-        print("\nAdding %d bundles to package:" % len(bundles))
-        for bundle in bundles:
-            print("\t%s:%s" % (bundle["name"], bundle["version"]))
+                # The package is created, in a single request, and downloaded while we map the next archive
+                results.append((entry, self.async_acc.submit(self.finish_package, builder), None))
 
-        new_package.add_bundles([b["id"] for b in bundles])
+        self.write_batch_results(self.args.summary, results)
 
     def main(self):
 
-        for agent_archive in self.args.agent:
+        if self.args.batch:
+            inputs = self.batch_inputs(self.args.batch, [".tar", ".tar.gz", ".tgz"],
+                                       name=None,
+                                       os=self.args.os,
+                                       appserver=self.args.appserver,
+                                       agent_version=self.args.agent_version)
+            agent_archives = [entry["file"] for entry in inputs]
+        else:
+            agent_archives = self.args.agent
+
+        for agent_archive in agent_archives:
             if not os.path.exists(agent_archive):
                 print("ERROR: %s does not exist" % agent_archive)
                 sys.exit(1)
@@ -416,10 +590,16 @@ class App(pyacc.AccCommandLineApp):
         bundle_files = self.fetch_bundles()
 
         print("\nIndexing bundles:")
-        filename_map = self.index_bundles(bundle_files)
+        bundle_index = self.index_bundles(bundle_files)
+
+        print("\nScanning agent archives")
+        archive_scans = self.scan_archives(scan_agent_archive, agent_archives)
+
+        if self.args.batch:
+            return self.run_batch(inputs, archive_scans, bundle_index)
 
-        for agent_archive in self.args.agent:
-            new_package = self.create_package_from_archive(agent_archive, filename_map)
+        for agent_archive, archive_scan in zip(agent_archives, archive_scans):
+            new_package = self.create_package_from_archive(agent_archive, archive_scan, bundle_index)
 
             print("\nCreated package id is: %s" % new_package["id"])
 
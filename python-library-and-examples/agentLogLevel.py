@@ -2,10 +2,11 @@
 
 from __future__ import print_function
 
+import sys
+
 import pyacc
 
 
-# TODO should be able to specifiy agent ids
 class App(pyacc.AccCommandLineApp):
     """
     Show or set the log level of connected agents
@@ -21,20 +22,38 @@ class App(pyacc.AccCommandLineApp):
             '-u', '--update', dest='update', action='store',
             help="update to value")
 
+        self.parser.add_argument('--query', action="store",
+                                 help='Only the agents matching a query, e.g. --query="appServerName:Tomcat"')
+        self.parser.add_argument('--workers', type=int, default=pyacc.CONCURRENCY,
+                                 help="Number of updates in flight at once (default %(default)s)")
+        self.parser.add_argument('--rate', type=float,
+                                 help="Start no more than this many updates a second (default no limit)")
+        self.parser.add_argument('--timeout', type=int, default=pyacc.TASK_TIMEOUT,
+                                 help="Seconds to wait for the updates to complete (default %(default)s)")
+        self.parser.add_argument('--no-wait', dest='wait', action='store_false',
+                                 help="Don't wait for the updates to complete")
+
         self.parser.add_argument('agent_ids', metavar='AGENT_ID', nargs='*', type=str, help='Use the given agent ids')
 
-    def main(self):
+    def get_agents(self):
+        cols = ("id", "agentName", "processName", "status", "serverName", "logLevel")
 
         if self.args.agent_ids:
             # Create a list of Agent objects initialized with the agent id.
-            # The data will be fetched (and cached) from the Config Server when the object
-            # is first queried (e.g. "agent["agentName"]).  Further queries on the object
-            # will not re-fetch it from the server.
-            agents = self.acc.agents_many(self.args.agent_ids)
-        else:
-            agents = self.acc.agents()
-
-        # Print the status of the agents
+            # The data for all of them is fetched (and cached) from the Config Server up front,
+            # in as few requests as possible.  Further queries on the objects
+            # (e.g. "agent["agentName"]) will not re-fetch them from the server.
+            return self.acc.agents_many(self.args.agent_ids, hydrate=True)
+
+        request_params = {}
+        if self.args.query:
+            # Filter on the Config Server rather than fetching every agent
+            request_params["q"] = self.args.query
+
+        return self.acc.agents(compact=cols, **request_params)
+
+    def to_update(self, agents):
+        """Print the status of the agents, yielding those which need updating"""
         for agent in agents:
 
             # agent["x"] will be resolved by Agent.__getitem__()
@@ -47,17 +66,35 @@ class App(pyacc.AccCommandLineApp):
                   agent["logLevel"]))
 
             if self.args.update and agent["logLevel"] != self.args.update:
-                print("Updating log level from %s to %s" % (agent["logLevel"], self.args.update))
+                yield agent
+
+    def main(self):
+
+        agents = self.get_agents()
+
+        if not self.args.update:
+            for agent in self.to_update(agents):
+                pass
+            return
+
+        # The updates are sent while the agents are still being listed, with up to --workers in flight
+        update = self.acc.log_level_update(self.args.update, workers=self.args.workers, rate=self.args.rate)
+
+        for result in update.submit(self.to_update(agents)):
+            if result.task:
+                print("Updating %s log level to %s, update task is %s" % (result.agent.item_id, self.args.update,
+                                                                         result.task.item_id))
+
+        if self.args.wait:
+            # Poll all the update tasks together rather than one agent at a time
+            for result in update.wait(self.args.timeout):
+                if result.status != pyacc.TASK_COMPLETED:
+                    print("\t".join([str(result.agent.item_id), str(result.task.item_id), result.status]))
 
-                try:
-                    agent.set_log_level(self.args.update)
-                    print("update task is", agent.update_id)
+        print(update.report())
 
-                    # Check the status of the last
-                    s = agent.task_status()
-                    print("status", s)
-                except pyacc.ACCHttpException as e:
-                    print("Problem setting log level:", e)
+        if update.failures():
+            sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -49,12 +49,14 @@ class App(pyacc.AccCommandLineApp):
 
     def main(self):
 
+        cols = ("id", "agentName", "osName", "appServerName", "appServerVersion", "status", "metricCount", "version")
+
         if self.args.agent_ids:
             # Create a list of Agent objects initialized with the agent id.
-            # The data will be fetched (and cached) from the Config Server when the object
-            # is first queried (e.g. "agent["agentName"]).  Further queries on the object
-            # will not re-fetch it from the server.
-            agents = self.acc.agents_many(self.args.agent_ids)
+            # The data for all of them is fetched (and cached) from the Config Server up front,
+            # in as few requests as possible.  Further queries on the objects
+            # (e.g. "agent["agentName"]) will not re-fetch them from the server.
+            agents = self.acc.agents_many(self.args.agent_ids, hydrate=True)
         else:
             request_params = {}
 
@@ -76,11 +78,11 @@ class App(pyacc.AccCommandLineApp):
                 # agents, unless a page has explicitly been specified
                 request_params["page"] = 0
 
-            # This will fetch a filtered list of agents a page a time when we iterate over it
-            agents = self.acc.agents(**request_params)
+            # This will fetch a filtered list of agents a page a time when we iterate over it.
+            # We only need the columns we print, so just keep those rather than the whole agent.
+            agents = self.acc.agents(compact=cols, **request_params)
 
         # Print the status of the agents
-        cols = ("id", "agentName", "osName", "appServerName", "appServerVersion", "status", "metricCount", "version")
         print("\t".join(cols))
 
         for agent in agents:
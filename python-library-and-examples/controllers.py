@@ -22,13 +22,13 @@ class App(pyacc.AccCommandLineApp):
     def main(self):
 
         if self.args.controller_ids:
-            # Create a list of Agent objects initialized with the agent id.
-            # The data will be fetched from the Config Server when the object
-            # is queried (e.g. "agent["agentName"])
-            controllers = self.acc.controllers_many(self.args.controller_ids)
+            # Create a list of Controller objects initialized with the controller id.
+            # The data for all of them is fetched from the Config Server up front,
+            # in as few requests as possible.
+            controllers = self.acc.controllers_many(self.args.controller_ids, hydrate=True)
         else:
-            # This will fetch all agents (a page a time)
-            controllers = self.acc.controllers()
+            # This will fetch all agents (a page a time), keeping just the fields we print
+            controllers = self.acc.controllers(compact=("id", "serverName", "version", "available"))
 
         for controller in controllers:
 
@@ -2,7 +2,7 @@
 
 from __future__ import print_function
 
-import os
+import sys
 from datetime import datetime
 
 import pyacc
@@ -35,6 +35,13 @@ class App(pyacc.AccCommandLineApp):
 
         self.parser.add_argument('--all', action="store_true", help='Generate reports for all agents (use with caution)')
 
+        self.parser.add_argument('--create-workers', type=int, default=pyacc.REPORT_WORKERS,
+                                 help='Number of report tasks to create at once (default %(default)s)')
+        self.parser.add_argument('--download-workers', type=int, default=pyacc.DOWNLOAD_WORKERS,
+                                 help='Number of reports to download at once (default %(default)s)')
+        self.parser.add_argument('--timeout', type=int, default=pyacc.TASK_TIMEOUT,
+                                 help='Seconds to wait for each report to be generated (default %(default)s)')
+
         self.parser.add_argument('agent_ids', metavar='AGENT_ID', nargs='*', type=int, help='Create reports for the given agent ids')
 
     def main(self):
@@ -49,77 +56,75 @@ class App(pyacc.AccCommandLineApp):
                 print("Please specify some agent ids to create diagnostic reports for, or --all")
                 return
             agents = self.acc.agents_many(self.args.agent_ids)
-        tasks = []
 
         # First build map of agents/tasks
-        task_lookup = {}
+        self.task_lookup = {}
         for task in self.acc.diagnostic_report_tasks(size=100):
             # print(task)
             if task["status"] != pyacc.TASK_FAILED:
-                task_lookup.setdefault(task["agentId"], []).append(task)
-
-        # Now loop for each specified agent and generate the report
-        for agent in agents:
-            task = None
-
-            if self.args.minutes:
-                tasks_agent = task_lookup.get(agent.item_id)
-                if tasks_agent:
-                    # print("Tasks for this agent are", tasks_agent)
-                    # Watch the last task we collected for that agent.
-                    task_agent = tasks_agent[-1]
-                    cts = task_agent["completionTimestamp"]
-                    if cts:
-                        diff = datetime.now() - pyacc.parse_date(cts)
-                        print("Have existing report which which is this old:", diff)
-                        if diff.seconds < (self.args.minutes * 60):
-                            # Use this one, don't create another report
-                            task = task_agent
-                            print("Not creating a new report for agent %s as task %s (%s) is less than %d minutes old" % (agent.item_id, task.item_id, task["status"], self.args.minutes))
-            if not task:
-                try:
-                    task = agent.create_diagnostic_report()
-                    print("Task %d created for agent %s" % (task["id"], agent["agentName"]))
-                except pyacc.ACCHttpException as e:
-                    if e.status == 303:
-                        print("Task already in progress for agent id", agent.item_id)
-                        tasks_agent = task_lookup.get(agent.item_id)
-                        if tasks_agent:
-                            task_agent = tasks_agent[-1]
-                            if task_agent:
-                                task = task_agent
-                                print("Watching task id %s instead of creating new task" % task.item_id)
-
-                    elif e.status == 404:
-                        print("No such agent id", agent.item_id)
-                    else:
-                        raise
-            if task:
-                tasks.append(task)
-
-        if not tasks:
-            print("No tasks")
-            return
-
-        # Wait for tasks to complete and download
-
-        for task in self.acc.wait_for_tasks(tasks):
-            # print(task)
+                self.task_lookup.setdefault(task["agentId"], []).append(task)
+
+        # Create the tasks, wait for them and download the reports as a zip, all at the same time:
+        # each report is written as soon as its task completes, while other tasks are still being created.
+        # Currently only zip format is supported
+        pipeline = self.acc.diagnostic_report_pipeline(self.create, self.args.create_workers,
+                                                       self.args.download_workers, self.args.timeout)
+
+        for result in pipeline.run(agents):
+            if result.status == pyacc.TASK_COMPLETED:
+                print("Wrote", result.filename)
+            elif result.status in (pyacc.TASK_FAILED, "TIMEOUT"):
+                print("Ignoring task %s for agent %s as it did not complete (%s)" % (
+                    result.task.item_id, result.agent.item_id, result.status))
+            elif result.error:
+                print("Problem with the report for agent %s: %s" % (result.agent.item_id, result.error))
+
+        print(pipeline.report())
 
-            if task["status"] == pyacc.TASK_COMPLETED:
-                # Download the report as a zip and write to a file
-                # Currently only zip format is supported
-                diagnostic_report = task.get_report();
+        if pipeline.failures():
+            sys.exit(1)
 
-                if os.path.exists(diagnostic_report.filename()):
-                    print("Report %s already exists, skipping download" % diagnostic_report.filename())
+    def create(self, agent):
+        """
+        Return the task to wait for to get a report for agent: an existing task if there is a recent
+        enough one or one is in progress, otherwise a new one.  None if there is no such agent.
+        """
+        task = None
+
+        if self.args.minutes:
+            tasks_agent = self.task_lookup.get(agent.item_id)
+            if tasks_agent:
+                # print("Tasks for this agent are", tasks_agent)
+                # Watch the last task we collected for that agent.
+                task_agent = tasks_agent[-1]
+                cts = task_agent["completionTimestamp"]
+                if cts:
+                    diff = datetime.now() - pyacc.parse_date(cts)
+                    print("Have existing report which which is this old:", diff)
+                    if diff.seconds < (self.args.minutes * 60):
+                        # Use this one, don't create another report
+                        task = task_agent
+                        print("Not creating a new report for agent %s as task %s (%s) is less than %d minutes old" % (agent.item_id, task.item_id, task["status"], self.args.minutes))
+        if not task:
+            try:
+                task = agent.create_diagnostic_report()
+                print("Task %d created for agent %s" % (task["id"], agent["agentName"]))
+            except pyacc.ACCHttpException as e:
+                if e.status == 303:
+                    print("Task already in progress for agent id", agent.item_id)
+                    tasks_agent = self.task_lookup.get(agent.item_id)
+                    if tasks_agent:
+                        task_agent = tasks_agent[-1]
+                        if task_agent:
+                            task = task_agent
+                            print("Watching task id %s instead of creating new task" % task.item_id)
+
+                elif e.status == 404:
+                    print("No such agent id", agent.item_id)
                 else:
-                    print("Writing", diagnostic_report.filename())
-                    # print(diagnostic_report)
-                    diagnostic_report.download()
-            else:
-                print("Ignoring this task as did not complete in time")
-                print(task)
+                    raise
+
+        return task
 
 if __name__ == "__main__":
     App().run()
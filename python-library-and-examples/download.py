@@ -2,7 +2,7 @@
 
 from __future__ import print_function
 
-import os
+import sys
 
 import pyacc
 
@@ -24,6 +24,8 @@ class App(pyacc.AccCommandLineApp):
 
         self.parser.add_argument('--last', action="store_true", help='Sort latest files first')
         self.parser.add_argument('--page', action="store", help='Page of data to fetch')
+        self.parser.add_argument('--workers', action="store", type=int, default=pyacc.DOWNLOAD_WORKERS,
+                                 help='Number of files to download at once (default %(default)s)')
 
     def main(self):
 
@@ -57,21 +59,14 @@ class App(pyacc.AccCommandLineApp):
                     str(file_meta["size"])
                 ]))
         else:
-            # Download the file ids from the config server
-            for file_meta in list_of_files:
-                if not self.args.write:
-                    # Just print the result
-                    result = file_meta.download_file()
-                    print(result)
-                else:
-                    # Write the file out
-                    dest_path = "acc_%s_%s" % (file_meta["id"],  file_meta["name"])
-                    if os.path.exists(dest_path):
-                        print("Skipping as already exists:", dest_path)
-                    else:
-                        print("Writing", file_meta["id"], file_meta["name"], "to", dest_path)
-                        with open(dest_path, "wb") as fout:
-                            fout.write(file_meta.download_file())
+            # Stream the files to acc_<id>_<name>, several at once, checking each
+            # against the size the config server reports for it
+            failed = False
+            for file_meta, dest_path, e in self.acc.download_many(list_of_files, workers=self.args.workers):
+                failed = failed or e is not None
+
+            if failed:
+                sys.exit(1)
 
 if __name__ == "__main__":
     App().run()
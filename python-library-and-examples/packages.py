@@ -160,9 +160,19 @@ class App(pyacc.AccCommandLineApp):
             print(new_package)
 
     def download(self):
-        # The package will be named automatically by a name suggested from the Config Server
-        for package in self._get_packages():
-            filename = package.download(".", self.args.format)
+        # The package will be named automatically by a name suggested from the Config Server.
+        # Several packages are downloaded at a time.
+        failed = []
+        for package, filename, e in self.acc.download_many(self._get_packages(), base_dir=".",
+                                                           archive_format=self.args.format):
+            if e:
+                failed.append((package, e))
+
+        if failed:
+            print("\n%d packages failed to download:" % len(failed))
+            for package, e in failed:
+                print("\t", package.item_id, e)
+            sys.exit(1)
 
     def modify(self):
 
@@ -298,23 +308,28 @@ class App(pyacc.AccCommandLineApp):
             return self.list_overrides()
 
         if self.args.list:
+            bundles = []
             for package in self.acc.packages_many(self.args.package_ids):
                 # TODO we could validate our overrides against the overrides in the bundle
                 for bundle in package.bundles():
                     if bundle["name"] == self.args.bundle:
-
-                        print("# Base properties in bundle: %s version: %s" % (bundle["name"], bundle["version"]))
-                        profile = bundle.profile()
-                        profile.get_json()
-                        # print(profile)
-
-                        for prop in profile["properties"] or []:
-                            print("%s=%s" % (prop["name"], prop["value"] or ""))
-                        print()
+                        bundles.append(bundle)
                         break
                 else:
                     print("didn't find bundle %s in the package" % self.args.bundle)
                     break
+
+            # Fetch the profiles of the bundles several at a time
+            profiles = self.acc.bundle_profiles(bundles)
+
+            for bundle in bundles:
+                print("# Base properties in bundle: %s version: %s" % (bundle["name"], bundle["version"]))
+                profile = profiles[bundle.item_id]
+                # print(profile)
+
+                for prop in profile["properties"] or []:
+                    print("%s=%s" % (prop["name"], prop["value"] or ""))
+                print()
             return
 
         val_re = re.compile("^([#]?)(.*)=(.*)")
@@ -3,23 +3,18 @@
 from __future__ import print_function
 
 import pyacc
-import pickle
 import os
 import sys
 import re
 
-from distutils.version import LooseVersion
-
 from pyacc import safe
 
-CACHE_FILE = "/tmp/bundle_property_cache"
-
 
-class App(pyacc.AccCommandLineApp):
+class App(pyacc.PackageBatchMixin, pyacc.AccCommandLineApp):
     """
     Create a package based on the content of the IntroscopeAgent.profile.
-    The Bundles included in the package are chosen based on the content of the profile.
-    TODO create overrides for any unknown profile items.
+    The Bundles included in the package are chosen based on the content of the profile, and
+    overrides are added for the properties which the bundles don't have or set differently.
     """
 
     appservers = ["other", "ctg-server", "glassfish", "interstage", "jboss", "tomcat", "weblogic", "websphere"]
@@ -42,11 +37,33 @@ class App(pyacc.AccCommandLineApp):
         self.parser.add_argument('--format', action='store',
                                      help='write files in the given format. "archive" means zip for windows packages, tar.gz for unix packages',
                                      default="archive", choices=["zip", "tar", "archive"])
+        self.parser.add_argument('--batch', action='store', metavar="DIR_OR_MANIFEST",
+                                 help="create packages for every .profile in a directory, or listed in a CSV manifest "
+                                      "with a file column and optional name, os, appserver and agent_version columns")
+        self.parser.add_argument('--summary', action='store', default="packages.csv",
+                                 help="CSV file listing the packages created by --batch (default packages.csv)")
         self.parser.add_argument('introscope_profile', metavar='introscope_profile', nargs='*', type=str, help='Introscope Profile')
 
-    def make_property_map(self):
-        bm = {}
+    def property_cache_path(self):
+        """
+        The property cache maps bundle id -> {"version": version, "properties": {name: value}}
+        for the non hidden properties of each bundle's profile.
+        """
+        return self.acc_env.cache_path("%s-bundle-properties.json" % (self.acc_env.profile or "default"))
+
+    # noinspection PyMethodMayBeStatic
+    def is_cached(self, cache, bundle):
+        entry = cache.get(str(bundle["id"]))
+        return entry and entry["version"] == bundle["version"]
+
+    def make_bundle_index(self):
+        bundle_index = pyacc.BundleIndex()
 
+        # Only bundles which are new or have changed version since the last run need their profile fetching
+        cache = pyacc.read_json_file(self.property_cache_path())
+        new_cache = {}
+
+        bundles = []
         for bundle in self.acc.bundles():
 
             if self.args.verbose:
@@ -68,32 +85,40 @@ class App(pyacc.AccCommandLineApp):
                     # safe(bundle["dependencies"]),
                 ]))
 
-            profile = bundle.profile()
-            # profile.get_json()
-            # print(profile)
+            bundles.append(bundle)
+
+        # Fetch the profiles we need several at a time
+        profiles = self.acc.bundle_profiles([bundle for bundle in bundles if not self.is_cached(cache, bundle)])
+
+        for bundle in bundles:
+            entry = cache.get(str(bundle["id"]))
+
+            if self.is_cached(cache, bundle):
+                properties = entry["properties"]
+            else:
+                profile = profiles[bundle.item_id]
+                # print(profile)
+
+                properties = {}
+                for prop in profile["properties"] or []:
+                    if not prop["hidden"]:
+                        properties[prop["name"]] = prop["value"]
 
-            # The map looks like this
-            # {"propname": {"bundlename}": {"bundleversion"}: bundle }}
+            new_cache[str(bundle["id"])] = {"version": bundle["version"], "properties": properties}
 
-            # i.e. property name -> bundle name -> bundle version
-            bundle.profile_map = {}
+            # The index maps property name -> bundle name -> bundle version -> bundle
+            # and keeps the value of each property in each bundle
             print("Bundle %s:%s" % (bundle["name"], bundle["version"]))
 
-            for prop in profile["properties"] or []:
-                if not prop["hidden"]:
-                    # print(prop)
-                    bundle_entry = bm.setdefault(prop["name"], {})
-                    bundle_entry2 = bundle_entry.setdefault(bundle["name"], {})
-                    bundle_entry2.setdefault(bundle["version"], bundle)
+            for name, value in properties.iteritems():
+                print("  %s=%s" % (name, value))
 
-                    # Save a map of the properties within the bundle object so they get saved in the pickle
-                    print("  %s=%s" % (prop["name"], prop["value"]))
-                    bundle.profile_map[prop["name"]] = prop["value"]
+            bundle_index.add_properties(bundle, properties)
 
-        # print("This is the big map")
-        # print(bm)
+        if new_cache != cache:
+            pyacc.write_json_file(self.property_cache_path(), new_cache)
 
-        return bm
+        return bundle_index
 
     def is_appserver(self, bundle):
         for f in bundle["facets"]:
@@ -102,43 +127,37 @@ class App(pyacc.AccCommandLineApp):
                 return True
         return False
 
-    def add_override(self, bundle, prop, value):
+    def add_override(self, bundle, prop, value, user_key=None):
+        """user_key is "+" for properties which the bundle doesn't already have"""
         d = self.overrides.setdefault(bundle, {})
-        d[prop] = value
+        d[prop] = (value, user_key)
 
     def lookup(self, prop, value):
 
-        bundle_entry = self.bm.get(prop)
+        bundle_entry = self.bundle_index.lookup("property", prop)
 
         if not bundle_entry:
             print("Unknown property '%s'" % prop)
-            self.add_override("java-agent", prop, value)
+            self.add_override("java-agent", prop, value, user_key="+")
         else:
             last_bundle = None
 
             for bundle_name, versions in bundle_entry.iteritems():
                 print("Found property '%s' in bundle '%s'" % (prop, bundle_name))
                 for version, bundle in versions.iteritems():
-                    try:
-                        print("  %s:%s:%s\t\t%s=%s" % (bundle["id"], bundle["name"], bundle["version"], prop, bundle.profile_map[prop]))
-                    except KeyError:
-                        print("This is the profile map for", bundle["name"], bundle["version"])
-                        print(bundle.profile_map)
-                        raise
+                    print("  %s:%s:%s\t\t%s=%s" % (bundle["id"], bundle["name"], bundle["version"], prop, self.bundle_index.value(bundle, prop)))
 
                 bundle_appropriate_version = self.select_version(bundle_name, versions)
 
                 if bundle_appropriate_version:
 
-                    try:
-                        bundle_appropriate_version.HITCOUNT +=1 # tag this on
-                    except AttributeError:
-                        bundle_appropriate_version.HITCOUNT = 1
+                    bundle_id = bundle_appropriate_version["id"]
+                    self.hit_counts[bundle_id] = self.hit_counts.get(bundle_id, 0) + 1
 
                     if self.appserver and self.is_appserver(bundle_appropriate_version):
                         print("Ignoring bundle %s as already have an appserver %s" % (bundle_appropriate_version["name"], self.appserver["name"]))
                     elif not last_bundle:
-                        if not self.appserver and bundle_appropriate_version.profile_map[prop] == value:
+                        if not self.appserver and self.bundle_index.value(bundle_appropriate_version, prop) == value:
                             if self.is_appserver(bundle_appropriate_version):
                                 self.appserver = bundle_appropriate_version
                                 print("HAVE AN APPSERVER BUNDLE", self.appserver)
@@ -146,10 +165,10 @@ class App(pyacc.AccCommandLineApp):
                         print("Initially selecting", bundle_appropriate_version["name"])
                         last_bundle = bundle_appropriate_version
 
-                    elif last_bundle.profile_map[prop] == value:
+                    elif self.bundle_index.value(last_bundle, prop) == value:
                         print("Sticking with", last_bundle["name"])
                     else:
-                        if bundle_appropriate_version.profile_map[prop] == value:
+                        if self.bundle_index.value(bundle_appropriate_version, prop) == value:
                             print("Taking bundle %s over %s" % (bundle_appropriate_version["name"], last_bundle["name"]))
                             last_bundle = bundle_appropriate_version
                         else:
@@ -159,12 +178,12 @@ class App(pyacc.AccCommandLineApp):
                 print("Finally Adding %s for %s" % (last_bundle["name"], prop))
                 self.included_bundles[last_bundle["name"]] = last_bundle
 
-                if not last_bundle.profile_map.get(prop):
+                if not self.bundle_index.value(last_bundle, prop):
                     # This means that the value appears in one version of the bundle, but not the one we selected.
                     print("Adding missing property as an override")
-                    self.add_override(last_bundle["name"], prop, value)
-                elif last_bundle.profile_map[prop] != value:
-                    print("Adding override", last_bundle.profile_map[prop], value)
+                    self.add_override(last_bundle["name"], prop, value, user_key="+")
+                elif self.bundle_index.value(last_bundle, prop) != value:
+                    print("Adding override", self.bundle_index.value(last_bundle, prop), value)
                     self.add_override(last_bundle["name"], prop, value)
 
     def select_version(self, bundle_name, versions):
@@ -177,26 +196,16 @@ class App(pyacc.AccCommandLineApp):
             print("Already selected version %s for bundle %s" % (exist["version"], bundle_name))
             return exist
         else:
-            v = versions.get(self.args.agent_version)
+            v = versions.get(self.agent_version)
             if v:
                 print("Found desired version %s for bundle %s" % (v["version"], bundle_name))
                 return v
             else:
                 # Pick the highest version
-                vmax = None
-                for version, bundle in versions.iteritems():
-                    v = LooseVersion(version), bundle
-                    print("Have %s" % v[0])
-                    if not vmax:
-                        vmax = v
-                    elif v[0] > vmax[0]:
-                        vmax = v
-                    else:
-                        # stick with what we've got
-                        pass
+                vmax = self.bundle_index.highest(bundle_name, versions)
                 if vmax:
-                    print("Selected %s:%s" % (vmax[1]["name"], vmax[1]["version"]))
-                    return vmax[1]
+                    print("Selected %s:%s" % (vmax["name"], vmax["version"]))
+                    return vmax
 
         return None
 
@@ -215,18 +224,14 @@ class App(pyacc.AccCommandLineApp):
         self.included_bundles = {}
         self.appserver = None
         self.overrides = {}
+        self.hit_counts = {}
+        self.agent_version = self.args.agent_version
 
-        if os.path.exists(CACHE_FILE):
-            print("Reading bundle property index from cache", CACHE_FILE)
+        print("Building bundle property index, using cache", self.property_cache_path())
+        self.bundle_index = self.make_bundle_index()
 
-            with open(CACHE_FILE, "r") as fin:
-                self.bm = pickle.load(fin)
-        else:
-            print("Building bundle property index", CACHE_FILE)
-            self.bm = self.make_property_map()
-
-            with open(CACHE_FILE, "w") as fout:
-                pickle.dump(self.bm, fout)
+        if self.args.batch:
+            return self.run_batch()
 
         if self.args.introscope_profile:
             for name in self.args.introscope_profile:
@@ -238,6 +243,11 @@ class App(pyacc.AccCommandLineApp):
             self.do_one(sys.stdin)
 
     def do_one(self, fileobj):
+        self.map_profile(fileobj)
+        self.create_package()
+
+    def map_profile(self, fileobj):
+        """Choose the bundles and overrides for the properties in fileobj"""
 
         for raw in fileobj:
             line = raw.strip()
@@ -258,24 +268,35 @@ class App(pyacc.AccCommandLineApp):
         print("\nThese are the selected bundles:\n")
 
         for bundle in self.included_bundles.itervalues():
-            print("%s:%s:%s (%d)" % (bundle["id"], bundle["name"], bundle["version"], bundle.HITCOUNT))
+            print("%s:%s:%s (%d)" % (bundle["id"], bundle["name"], bundle["version"], self.hit_counts[bundle["id"]]))
 
-        # TODO add overrides to the package
         print("These are the overrides")
         for bundle, props in self.overrides.iteritems():
             print("\n# BUNDLE: %s" % bundle)
-            for prop, value in props.iteritems():
+            for prop, (value, user_key) in props.iteritems():
                 print("%s=%s" % (prop, value))
 
-        self.create_package()
-
     def create_package(self):
+        try:
+            builder = self.make_builder(self.args.name, self.args.os, self.args.appserver)
+        except pyacc.ACCException as e:
+            print("ERROR: %s" % e)
+            sys.exit(1)
+
+        # The package is created complete with its bundles in one request
+        new_package = builder.build()
 
-        appserver = self.args.appserver or (self.appserver and self.appserver["name"])
+        filename = new_package.download(".", self.args.format)
+
+        print("wrote", filename)
+
+    def make_builder(self, name, os_name, appserver):
+        """Return a PackageBuilder for a package of the bundles selected by map_profile"""
+
+        appserver = appserver or (self.appserver and self.appserver["name"])
 
         if not appserver:
-            print("ERROR: Could not automatically determine appserver type - please specify with --appserver")
-            sys.exit(1)
+            raise pyacc.ACCException("Could not automatically determine appserver type - please specify with --appserver")
 
         print("Creating package for %s" % appserver)
 
@@ -287,22 +308,68 @@ class App(pyacc.AccCommandLineApp):
 
         print("Creating package at version %s" % v2)
 
-        new_package = self.acc.package_create(name=self.args.name,
-                                              os=self.args.os,
-                                              appserver=appserver,
-                                              em_host=self.args.em_host,
-                                              agent_version=v2,
-                                              process_display_name=self.args.process_display_name or appserver,
-                                              comment=self.args.comment,
-                                              draft=False)
+        builder = self.acc.package_builder(name=name,
+                                           os=os_name,
+                                           appserver=appserver,
+                                           em_host=self.args.em_host,
+                                           agent_version=v2,
+                                           process_display_name=self.args.process_display_name or appserver,
+                                           comment=self.args.comment)
 
         bundles = [b["id"] for b in self.included_bundles.values()]
         print("Adding bundles to package:", bundles)
-        new_package.add_bundles(bundles)
+        builder.add_bundles(bundles)
 
-        filename = new_package.download(".", self.args.format)
+        # The overrides go in the same request as the bundles
+        for bundle, props in self.overrides.iteritems():
+            for prop, (value, user_key) in props.iteritems():
+                builder.add_override(bundle, prop, value, user_key=user_key)
 
-        print("wrote", filename)
+        return builder
+
+    def finish_package(self, builder):
+        """Create the package and download it. Returns (package, filename)"""
+        new_package = builder.build()
+
+        return new_package, new_package.download(".", self.args.format, progress=False)
+
+    def run_batch(self):
+        """
+        Create a package for each profile. The profiles are mapped one after another, grouped by os,
+        appserver and agent version, while the packages are created and downloaded concurrently.
+        """
+        inputs = self.batch_inputs(self.args.batch, [".profile"],
+                                   name=None,
+                                   os=self.args.os,
+                                   appserver=self.args.appserver,
+                                   agent_version=self.args.agent_version)
+
+        inputs.sort(key=lambda entry: (entry["os"], entry["appserver"], entry["agent_version"]))
+
+        results = []
+
+        for entry in inputs:
+            print("\nMapping %s" % entry["file"])
+
+            self.included_bundles = {}
+            self.appserver = None
+            self.overrides = {}
+            self.hit_counts = {}
+            self.agent_version = entry["agent_version"]
+
+            try:
+                with open(entry["file"], "r") as fobj:
+                    self.map_profile(fobj)
+
+                builder = self.make_builder(entry["name"] or os.path.basename(entry["file"]).split(".")[0],
+                                            entry["os"], entry["appserver"])
+            except (IOError, KeyError, pyacc.ACCException) as e:
+                results.append((entry, None, e))
+                continue
+
+            results.append((entry, self.async_acc.submit(self.finish_package, builder), None))
+
+        self.write_batch_results(self.args.summary, results)
 
         # for prop in ["introscope.agent.pmi.enable.wsgwModule", "introscope.agent.sqlagent.sql.artonly"]:
 
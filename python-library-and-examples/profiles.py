@@ -27,7 +27,10 @@ class App(pyacc.AccCommandLineApp):
             bundles = self.acc.bundles_many(self.args.bundle_ids)
         else:
             # This will fetch all agents (a page a time)
-            bundles = self.acc.bundles()
+            bundles = list(self.acc.bundles())
+
+        # Fetch the profiles of the bundles several at a time
+        profiles = self.acc.bundle_profiles(bundles)
 
         for bundle in bundles:
 
@@ -35,7 +38,7 @@ class App(pyacc.AccCommandLineApp):
             # bundle["id"]
             # print("Bundle:", bundle)
 
-            p = bundle.profile()
+            p = profiles[bundle.item_id]
             props = p["properties"]
 
             if props:
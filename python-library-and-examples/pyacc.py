@@ -34,8 +34,6 @@ https://github.com/CA-APM/ca-apm-acc-api-scripts
 
 TODO
 
-Push uploaded file to all agents
-
 Out-of-policy agents
 
 """
@@ -54,10 +52,45 @@ import pprint
 import mimetypes
 import datetime
 import time
+import socket
+import threading
+import collections
+import re
+import sqlite3
+import hashlib
+import shutil
+import tempfile
+import bisect
+import weakref
+import csv
+import Queue
+import contextlib
+import select
+
+from multiprocessing.pool import ThreadPool
+from distutils.version import LooseVersion
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where the bundle cache is only safe to share between threads
+    fcntl = None
 
 SERVER_URL = "https://example.com:8443"  # Can be http/8088 if security switch off on the Config Server
 SECURITY_TOKEN = ""  # you will need to generate your own.  See createApiSecurityToken.py
 PAGE_SIZE = 20
+POOL_SIZE = 10  # idle keep-alive connections retained per server
+IDEMPOTENT_METHODS = ("GET", "HEAD", "DELETE")  # requests AccRaw may safely resend on a fresh connection
+POOL_IDLE_TIMEOUT = 30  # secs before an idle connection is considered stale and discarded
+PAGE_WORKERS = 4  # threads used to prefetch pages of multi-page requests
+CONCURRENCY = 32  # requests in flight at once for AsyncAccApi
+DOWNLOAD_WORKERS = 4  # files downloaded at once by AccApi.download_many
+TASK_TIMEOUT = 600  # secs to wait for each agent to complete a task (AgentTasks, DiagnosticReportPipeline)
+REPORT_WORKERS = 4  # diagnostic report tasks created at once by DiagnosticReportPipeline
+FILE_CHUNK_SIZE = 1024 * 1024  # bytes read at a time by AccApi.iter_file
+BUNDLE_CACHE_SIZE = 1024  # MB of bundles kept in ~/.acc/cache/bundles
+RESPONSE_CACHE_SIZE = 64  # MB of json responses kept for conditional GETs
+RESPONSE_CACHE_TTL = 3600  # secs a cached json response is kept for revalidation
 debug_mode = False
 
 
@@ -77,6 +110,11 @@ class ACCConfigurationException(ACCException):
         return "Missing configuration item: '%s'" % self.configuration_item
 
 
+class ACCMirrorQueryException(ACCException):
+    """The request parameters can not be answered from the InventoryMirror"""
+    pass
+
+
 class ACCHttpException(ACCException):
 
     def __init__(self, res):
@@ -110,35 +148,142 @@ def safe(val):
     return str(val)
 
 
-def write_content_to_file(res, filename, chunk_size=1048576):
+def partial_filename(filename):
+    """Where the content of filename is written while it is being downloaded"""
+    return filename + ".part"
+
+
+def check_size(what, received, size):
+    """Raise ACCException if the received number of bytes of what is not the size reported for it"""
+    if size is not None and received != size:
+        raise ACCException("%s: received %d bytes but the config server reports %d" % (what, received, size))
+
+
+def write_content_to_file(res, filename, chunk_size=1048576, progress=True):
+    """
+    Write the response content to filename.
+
+    The content is written to a .part file which is renamed to filename once all of it
+    has been received, so an interrupted download never leaves a truncated filename behind.
+    If the response is 206 (Partial Content) it is appended to the existing .part file at
+    the offset given by its Content-Range.  The length written is checked against the
+    content-length, raising ACCException if the download is incomplete.
+    """
 
     # print("response headers:")
     # print(res.msg)
 
     if os.path.exists(filename):
         print("Skipping writing existing:", filename)
-    else:
-        content_length = long(res.msg["content-length"])
-        print("Content length is", content_length);
-
-        with open(filename, "wb") as fout:
+        res.close()
+        return
+
+    part_filename = partial_filename(filename)
+    offset = 0
+    content_length = res.getheader("content-length")
+    content_length = long(content_length) if content_length is not None else None
+    total_length = content_length
+
+    if res.status == httplib.PARTIAL_CONTENT:
+        # e.g. Content-Range: bytes 1048576-5242879/5242880
+        content_range = res.getheader("content-range", "").split()[-1]
+        byte_range, total = content_range.split("/")
+        offset = long(byte_range.split("-")[0])
+        total_length = long(total) if total != "*" else None
+        print("Resuming", filename, "from", offset)
+
+    if progress:
+        print("Content length is", content_length)
+
+    with open(part_filename, "r+b" if offset else "wb") as fout:
+        fout.seek(offset)
+        fout.truncate()
+
+        if progress:
             print("Fetching payload to:", filename)
-            print("-" * ((content_length * 2 / chunk_size) + 2))
+            print("-" * (((content_length or 0) * 2 / chunk_size) + 2))
 
-            while 1:
+        while 1:
+            if progress:
                 print("r", end="")
                 sys.stdout.flush()
 
-                content = res.read(chunk_size)
-                if not content:
-                    break
+            content = res.read(chunk_size)
+            if not content:
+                break
 
+            if progress:
                 print("w", end="")
                 sys.stdout.flush()
 
-                fout.write(content)
+            fout.write(content)
+
+        written = fout.tell()
+
+    if progress:
         print()
 
+    if total_length is not None and written != total_length:
+        raise ACCException("Incomplete download of %s: received %d of %d bytes, re-run to resume" % (
+                           filename, written, total_length))
+
+    os.rename(part_filename, filename)
+
+
+def progress_printer(label, interval=0.5):
+    """
+    Return a progress(done, total, seconds) callback, for uploads etc, which prints the
+    percentage done and throughput of label on one line at most every interval seconds
+    """
+    state = {"printed": 0}
+
+    def progress(done, total, seconds):
+        if done < total and seconds - state["printed"] < interval:
+            return
+        state["printed"] = seconds
+
+        rate = done / seconds / 1048576 if seconds else 0
+        print("\r%s: %3d%% %.1f MB/s" % (label, done * 100 / (total or 1), rate), end="\n" if done >= total else "")
+        sys.stdout.flush()
+
+    return progress
+
+
+def imap_ordered(func, items, workers, window=None, pool=None):
+    """
+    Like itertools.imap, but func is called on a pool of worker threads.
+    Results are yielded in the order of items, with at most window (default 2 x workers)
+    calls outstanding ahead of the consumer.  Exceptions raised by func are re-raised
+    when the consumer reaches the corresponding result.
+    If an existing ThreadPool is passed it is used (and left running) rather than creating one.
+    """
+    if workers <= 1 and not pool:
+        for item in items:
+            yield func(item)
+        return
+
+    window = window or workers * 2
+    own_pool = not pool
+    pool = pool or ThreadPool(workers)
+    pending = collections.deque()
+
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        if own_pool:
+            pool.terminate()
+
+
+def project(json_obj, fields):
+    """Return a copy of json_obj with only the keys in fields (plus id), dropping _links etc."""
+    return dict((key, value) for key, value in json_obj.iteritems() if key in fields or key == "id")
+
 
 def parse_date(date):
     """
@@ -158,6 +303,372 @@ def get_filename_from_content_disp(res):
     return filename or "unknown"
 
 
+class ConnectionPool(object):
+
+    """
+    A thread safe pool of persistent HTTP/1.1 connections to a single (scheme, netloc).
+
+    Connections are checked out for the duration of a request and are returned to the pool
+    by PooledResponse once the response body has been completely read. If the pool has no
+    idle connection a new one is created, so the pool never blocks; max_size bounds the
+    number of idle connections which are kept open for reuse.  Idle connections older than
+    idle_timeout seconds, or which the server has closed in the meantime (its keep-alive
+    timeout may well be shorter than ours), are closed rather than reused.
+    """
+
+    def __init__(self, scheme, netloc, max_size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+
+        # (connection, time returned to the pool) with the most recently used at the end
+        self.idle = []
+
+    def new_conn(self):
+        if self.scheme == "https":
+            return httplib.HTTPSConnection(self.netloc)
+        elif self.scheme == "http":
+            return httplib.HTTPConnection(self.netloc)
+        else:
+            raise ACCException("Unsupported scheme '%s' in server URL '%s://%s'" % (
+                               self.scheme, self.scheme, self.netloc))
+
+    def get(self):
+        """
+        Return a tuple of (connection, reused) where reused is True if the connection
+        came from the idle pool (and so may have been closed by the server in the meantime)
+        """
+        stale = []
+        conn = None
+
+        with self.lock:
+            now = time.time()
+            while self.idle:
+                idle_conn, last_used = self.idle.pop()
+                if now - last_used < self.idle_timeout and not self.is_closed(idle_conn):
+                    conn = idle_conn
+                    break
+                stale.append(idle_conn)
+
+        for idle_conn in stale:
+            idle_conn.close()
+
+        if conn:
+            return conn, True
+
+        debug("new connection to %s://%s" % (self.scheme, self.netloc))
+        return self.new_conn(), False
+
+    # noinspection PyMethodMayBeStatic
+    def is_closed(self, conn):
+        """
+        True if an idle connection can't be used: an idle socket only becomes readable when
+        the server has closed it (or sent something it shouldn't have)
+        """
+        if not conn.sock:
+            return True
+
+        try:
+            readable, writable, failed = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+
+        return bool(readable)
+
+    def put(self, conn):
+        """Return a connection to the pool, or close it if the pool is already full"""
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append((conn, time.time()))
+                return
+
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for conn, last_used in idle:
+            conn.close()
+
+
+class PooledResponse(object):
+
+    """
+    Wraps a httplib.HTTPResponse and hands the connection back to its pool
+    as soon as the response body has been completely read.
+    Everything else (status, reason, msg, getheader...) is delegated to the response.
+    """
+
+    def __init__(self, pool, conn, res):
+        self.pool = pool
+        self.conn = conn
+        self.res = res
+        self.check_finished()
+
+    def __getattr__(self, name):
+        return getattr(self.res, name)
+
+    def check_finished(self):
+        if self.conn and self.res.isclosed():
+            if self.res.will_close:
+                self.conn.close()
+            else:
+                self.pool.put(self.conn)
+            self.conn = None
+
+    def read(self, amt=None):
+        content = self.res.read(amt)
+        self.check_finished()
+        return content
+
+    def close(self):
+        """Discard the response. A partially read connection can not be reused"""
+        if self.conn and not self.res.isclosed():
+            self.conn.close()
+            self.conn = None
+        self.res.close()
+
+
+class MultipartBody(object):
+
+    """
+    A multipart/form-data request body which is read a piece at a time as it is sent, so
+    files of any size are uploaded in constant memory.  Its length, for the content-length
+    header, is known up front.
+
+    fields is a list of (name, value) and files a list of (name, filename, content) where
+    content is a string or a file object, which is read from its current position to the end.
+    If progress is given it is called as progress(bytes_read, total_bytes, seconds) as the
+    body is read.
+    """
+
+    boundary = '----------lImIt_of_THE_fIle_eW_$'
+
+    def __init__(self, fields, files, progress=None):
+        self.progress = progress
+
+        # Each part is (string or file object, start offset, length)
+        self.parts = []
+
+        for (key, value) in fields:
+            self.add_string('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (
+                            self.boundary, key, value))
+
+        for (key, filename, content) in files:
+            self.add_string('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                            'Content-Type: %s\r\n\r\n' % (
+                            self.boundary, key, filename, mimetypes.guess_type(filename)[0] or 'application/octet-stream'))
+
+            if hasattr(content, "read"):
+                start = content.tell()
+                content.seek(0, os.SEEK_END)
+                self.parts.append((content, start, content.tell() - start))
+                content.seek(start)
+            else:
+                self.add_string(content)
+
+            self.add_string('\r\n')
+
+        self.add_string('--%s--\r\n' % self.boundary)
+
+        self.length = sum(length for part, start, length in self.parts)
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        self.seek(0)
+
+    def add_string(self, s):
+        self.parts.append((s, 0, len(s)))
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset):
+        """Rewind, e.g. to resend the body on a new connection. Only offset 0 is supported"""
+        if offset != 0:
+            raise ValueError("MultipartBody can only seek to the start")
+
+        self.index = 0
+        self.offset = 0
+        self.position = 0
+        self.started = None
+
+        for part, start, length in self.parts:
+            if hasattr(part, "seek"):
+                part.seek(start)
+
+    def read(self, size=-1):
+        if self.started is None:
+            self.started = time.time()
+
+        if size < 0:
+            size = self.length - self.position
+
+        chunks = []
+
+        while size > 0 and self.index < len(self.parts):
+            part, start, length = self.parts[self.index]
+            want = min(size, length - self.offset)
+
+            if hasattr(part, "read"):
+                data = part.read(want)
+                if not data:
+                    raise ACCException("%s changed size while being uploaded" % getattr(part, "name", "file"))
+            else:
+                data = part[self.offset:self.offset + want]
+
+            chunks.append(data)
+            size -= len(data)
+            self.offset += len(data)
+
+            if self.offset == length:
+                self.index += 1
+                self.offset = 0
+
+        data = "".join(chunks)
+        self.position += len(data)
+
+        if self.progress and data:
+            self.progress(self.position, self.length, time.time() - self.started)
+
+        return data
+
+
+class MemoryResponseCache(object):
+
+    """
+    Keeps json response bodies along with their ETag/Last-Modified validators so that
+    AccRaw.http_get_json can make conditional GETs.  Entries are dropped ttl seconds
+    after they were stored and the least recently used are evicted when the bodies
+    held exceed max_bytes.
+
+    Entries are dictionaries of etag, last_modified, body and stored (time).
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_SIZE * 1024 * 1024, ttl=RESPONSE_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+
+            if time.time() - entry["stored"] > self.ttl:
+                self.size -= len(entry["body"])
+                return None
+
+            # Re-insert as the most recently used
+            self.entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= len(old["body"])
+
+            if len(entry["body"]) > self.max_bytes:
+                return
+
+            self.entries[key] = entry
+            self.size += len(entry["body"])
+
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted["body"])
+
+
+class DiskResponseCache(object):
+
+    """
+    As MemoryResponseCache, but each entry is a file in directory so the cache is shared
+    between runs.  File modification times record use, for least recently used eviction.
+    """
+
+    def __init__(self, directory, max_bytes=RESPONSE_CACHE_SIZE * 1024 * 1024, ttl=RESPONSE_CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = None  # estimate, worked out on first use
+        self.lock = threading.Lock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0o700)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + ".json")
+
+    def get(self, key):
+        path = self.path(key)
+
+        try:
+            with open(path, "rb") as fin:
+                entry = json.load(fin)
+        except (IOError, ValueError):
+            return None
+
+        if entry.get("key") != key or time.time() - entry["stored"] > self.ttl:
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return entry
+
+    def put(self, key, entry):
+        data = json.dumps(dict(entry, key=key))
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(data)
+        os.rename(tmp_path, self.path(key))
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for mtime, size, path in self.files())
+            else:
+                self.size += len(data)
+
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def files(self):
+        """Return a list of (mtime, size, path) of the cache files"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        """Remove the least recently used files until the cache is within max_bytes"""
+        files = sorted(self.files())
+        self.size = sum(size for mtime, size, path in files)
+
+        for mtime, size, path in files:
+            if self.size <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
+
 class AccRaw(object):
 
     """
@@ -165,11 +676,14 @@ class AccRaw(object):
     This is used by the higher level AccApi which is the interface designed for consumers.
     """
 
-    def __init__(self, server=SERVER_URL, token=SECURITY_TOKEN, page_size=20):
+    def __init__(self, server=SERVER_URL, token=SECURITY_TOKEN, page_size=20,
+                 pool_size=POOL_SIZE, pool_idle_timeout=POOL_IDLE_TIMEOUT, page_workers=PAGE_WORKERS,
+                 response_cache=None):
         self.server = server
         self.url = urlparse.urlparse(server)
         self.headers = {"content-type": "application/json"}
         self.page_size = page_size
+        self.page_workers = page_workers
         self.token = token
 
         if token:
@@ -177,26 +691,80 @@ class AccRaw(object):
 
         self.params = {}
 
-    def _get_conn(self):
-        if self.url.scheme == "https":
-            return httplib.HTTPSConnection(self.url.netloc)
-        elif self.url.scheme == "http":
-            return httplib.HTTPConnection(self.url.netloc)
-        else:
-            raise ACCException("Unsupported scheme '%s' in server URL '%s'" % (
-                               self.url.scheme, self.server))
+        # Keep-alive connections, one pool per (scheme, netloc)
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+
+        # A MemoryResponseCache or DiskResponseCache enables conditional GETs in http_get_json
+        self.response_cache = response_cache
+
+    def _get_pool(self, scheme=None, netloc=None):
+        key = (scheme or self.url.scheme, netloc or self.url.netloc)
+
+        with self.pools_lock:
+            pool = self.pools.get(key)
+            if not pool:
+                pool = self.pools[key] = ConnectionPool(key[0], key[1], self.pool_size, self.pool_idle_timeout)
+
+        return pool
+
+    def _request(self, method, url, body=None, headers=None):
+        """
+        Make a request on a pooled connection and return a PooledResponse.
+
+        If a reused connection turns out to have been closed by the server while it
+        was idle, the request is transparently retried once on a fresh connection.
+        A request which may have reached the server is only retried if it is idempotent
+        (GET, HEAD, DELETE), so that POSTs and PATCHes are never made twice.
+        """
+        pool = self._get_pool()
+        conn, reused = pool.get()
+
+        sent = False
+        try:
+            # def request(self, method, url, body=None, headers={}):
+            conn.request(method, url, body=body, headers=headers or {})
+            sent = True
+            res = conn.getresponse()
+        except (socket.error, httplib.BadStatusLine, httplib.CannotSendRequest) as e:
+            conn.close()
+            if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                raise
+
+            debug("stale connection (%r), reconnecting" % e)
+
+            if hasattr(body, "seek"):
+                body.seek(0)
+
+            conn = pool.new_conn()
+            conn.request(method, url, body=body, headers=headers or {})
+            res = conn.getresponse()
+
+        return PooledResponse(pool, conn, res)
+
+    def ensure_pool_size(self, pool_size):
+        """Keep at least pool_size idle connections, e.g. when making many concurrent requests"""
+        with self.pools_lock:
+            self.pool_size = max(self.pool_size, pool_size)
+            for pool in self.pools.values():
+                pool.max_size = self.pool_size
+
+    def close(self):
+        """Close any idle keep-alive connections"""
+        with self.pools_lock:
+            pools, self.pools = self.pools, {}
+
+        for pool in pools.values():
+            pool.close()
 
     def http_get_raw(self, url, headers):
 
         debug("url is GET %s%s" % (self.server, url))
         debug("request headers are %s" % headers)
 
-        conn = self._get_conn()  # create a new connection for each call.
-
-        # def request(self, method, url, body=None, headers={}):
-        conn.request("GET", url, headers=headers)
-        res = conn.getresponse()
-        return res
+        return self._request("GET", url, headers=headers)
 
     def http_get(self, part, item_id, headers=None, **kwargs):
         """
@@ -204,6 +772,16 @@ class AccRaw(object):
         the JSON object. Throw exception on any non 200 (OK) return codes
         """
 
+        url = self._build_url(part, item_id, **kwargs)
+
+        res = self.http_get_raw(url, headers or self.headers)
+
+        if res.status != httplib.OK and not (res.status == httplib.PARTIAL_CONTENT and "range" in (headers or {})):
+            raise ACCHttpException(res)
+
+        return res
+
+    def _build_url(self, part, item_id, **kwargs):
         if item_id is None:
             url = part
         else:
@@ -222,15 +800,49 @@ class AccRaw(object):
             this_params.update(kwargs)
             url += "?" + urllib.urlencode(this_params)
 
-        res = self.http_get_raw(url, headers or self.headers)
+        return url
 
-        if res.status != httplib.OK:
+    def http_get_json(self, part, item_id, cache=True, **kwargs):
+        """
+        GET a json object.  If there is a response cache (and cache is True) the request is
+        conditional on the ETag/Last-Modified of any cached copy, and a 304 (Not Modified)
+        response is answered from the cache.
+        """
+        if not (cache and self.response_cache):
+            return json.loads(self.http_get(part, item_id, **kwargs).read())
+
+        url = self._build_url(part, item_id, **kwargs)
+        key = self.server + url
+        entry = self.response_cache.get(key)
+
+        headers = self.headers.copy()
+        if entry:
+            if entry["etag"]:
+                headers["if-none-match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["if-modified-since"] = entry["last_modified"]
+
+        res = self.http_get_raw(url, headers)
+
+        if res.status == httplib.NOT_MODIFIED and entry:
+            res.read()
+            debug("not modified, using cached response")
+            body = entry["body"]
+        elif res.status == httplib.OK:
+            body = res.read()
+
+            etag = res.getheader("etag")
+            last_modified = res.getheader("last-modified")
+
+            if etag or last_modified:
+                self.response_cache.put(key, {"etag": etag,
+                                              "last_modified": last_modified,
+                                              "body": body,
+                                              "stored": time.time()})
+        else:
             raise ACCHttpException(res)
 
-        return res
-
-    def http_get_json(self, part, item_id, **kwargs):
-        return json.loads(self.http_get(part, item_id, **kwargs).read())
+        return json.loads(body)
 
     def http_post_raw(self, part, body, headers):
 
@@ -243,11 +855,7 @@ class AccRaw(object):
         debug(body)
         debug(headers)
 
-        conn = self._get_conn()
-        conn.request("POST", part, body=body, headers=headers)
-        res = conn.getresponse()
-
-        return res
+        return self._request("POST", part, body=body, headers=headers)
 
     def http_post(self, part, body):
         """
@@ -262,55 +870,26 @@ class AccRaw(object):
 
         raise ACCHttpException(res)
 
-    def http_post_multipart(self, part, fields, files):
-        content_type, body = self._encode_multipart_formdata(fields, files)
-#         print(content_type)
-#         print(body)
-        conn = self._get_conn()
-
-        conn.putrequest('POST', part)
+    def http_post_multipart(self, part, fields, files, progress=None):
+        """
+        POST a multipart/form-data body of fields and files (see MultipartBody), which is
+        streamed to the server rather than built up in memory.
+        """
+        body = MultipartBody(fields, files, progress)
 
-        conn.putheader('content-type', content_type)
-        conn.putheader('content-length', str(len(body)))
+        headers = {'content-type': body.content_type,
+                   'content-length': str(len(body))}
 
         if self.headers.get("authorization"):
-            conn.putheader('authorization', self.headers["authorization"])
-
-        conn.endheaders()
+            headers['authorization'] = self.headers["authorization"]
 
-        conn.send(body)
-
-        res = conn.getresponse()
-        # errcode, errmsg, headers = conn.getreply()
+        res = self._request("POST", part, body=body, headers=headers)
 
         if res.status in (httplib.CREATED, httplib.OK):
             return res, json.loads(res.read())
 
         raise ACCHttpException(res)
 
-    def _encode_multipart_formdata(self, fields, files):
-        limit = '----------lImIt_of_THE_fIle_eW_$'
-        form = []
-        for (key, value) in fields:
-            form.append('--' + limit)
-            form.append('Content-Disposition: form-data; name="%s"' % key)
-            form.append('')
-            form.append(value)
-
-        for (key, filename, value) in files:
-            form.append('--' + limit)
-            form.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (
-                        key, filename))
-            form.append('Content-Type: %s' % self._get_content_type(filename))
-            form.append('')
-            form.append(value)
-
-        form.append('--' + limit + '--')
-        form.append('')
-        body = '\r\n'.join(form)
-        content_type = 'multipart/form-data; boundary=%s' % limit
-        return content_type, body
-
     def http_patch_raw(self, part, body, headers):
         """
         Do a HTTP PATCH to ACC ConfigServer
@@ -321,11 +900,7 @@ class AccRaw(object):
         debug(body)
         debug(headers)
 
-        conn = self._get_conn()
-        conn.request("PATCH", part, body=body, headers=headers)
-        res = conn.getresponse()
-
-        return res
+        return self._request("PATCH", part, body=body, headers=headers)
 
     def http_patch(self, part, body):
         res = self.http_patch_raw(part, body, self.headers)
@@ -340,12 +915,7 @@ class AccRaw(object):
         debug("url is DELETE %s%s" % (self.server, url))
         debug("headers are %s" % headers)
 
-        conn = self._get_conn()  # create a new connection for each call.
-
-        # def request(self, method, url, body=None, headers={}):
-        conn.request("DELETE", url, headers=headers)
-        res = conn.getresponse()
-        return res
+        return self._request("DELETE", url, headers=headers)
 
     # noinspection PyMethodMayBeStatic
     def _get_content_type(self, filename):
@@ -362,66 +932,137 @@ class AccApi(AccRaw):
         self.info.get_json()
         return str(self.info)
 
-    def __init__(self, server=SERVER_URL, token=SECURITY_TOKEN, page_size=20):
-        super(AccApi, self).__init__(server, token, page_size)
+    def __init__(self, server=SERVER_URL, token=SECURITY_TOKEN, page_size=20,
+                 pool_size=POOL_SIZE, pool_idle_timeout=POOL_IDLE_TIMEOUT, page_workers=PAGE_WORKERS,
+                 response_cache=None):
+        super(AccApi, self).__init__(server, token, page_size, pool_size, pool_idle_timeout, page_workers,
+                                     response_cache)
 
         debug("Server: %s Token %s" % (server, token))
 
         self.info = AccInfo(self)
 
+        # Set to an InventoryMirror to answer agents/controllers/packages list queries locally
+        self.mirror = None
+
+        # Urls where filtering by id has failed, see hydrate
+        self.id_query_unsupported = set()
+
+        # Urls where asking for a projection of fields has failed, see PagedJsonObject
+        self.projection_unsupported = set()
+
+        # Set to a BundleCache to share downloaded bundles between runs
+        self.bundle_cache = None
+
+        # (type, id) -> the object for that entity, see entity()
+        self.identity_map = weakref.WeakValueDictionary()
+        self.identity_lock = threading.Lock()
+
     def __getitem__(self, key):
         return self.info[key]
 
+    def entity(self, cls, json_obj_or_item_id):
+        """
+        Return the cls object for an id (or json object), creating it if it is not in use already,
+        so that every reference to the same agent, bundle etc. shares one object and one copy of
+        its json. Json passed in replaces an existing object's json as the latest copy.
+
+        Only what the server says about an entity belongs on the shared object: anything to do
+        with one particular use of it (a download location, a task created for it...) should be
+        kept by the caller.
+        """
+        if isinstance(json_obj_or_item_id, dict):
+            item_id = json_obj_or_item_id.get("id")
+        else:
+            item_id = json_obj_or_item_id
+
+        if item_id is None or self.identity_map is None:
+            return cls(self, json_obj_or_item_id)
+
+        key = (cls, str(item_id))
+
+        with self.identity_lock:
+            obj = self.identity_map.get(key)
+
+            if obj is None:
+                obj = cls(self, json_obj_or_item_id)
+                self.identity_map[key] = obj
+            elif isinstance(json_obj_or_item_id, dict):
+                # Not merged, so that fields the server no longer sends go away.
+                # Callers which project the json mark the object partial again afterwards.
+                obj.json = json_obj_or_item_id
+                obj.partial = False
+
+        return obj
+
     def agent(self, item_id):
         """Create a lazily initialized Agent object"""
-        return Agent(self, item_id)
+        return self.entity(Agent, item_id)
 
-    def agents(self, **kwargs):
-        """Fetch agents meta-data as Agent objects"""
-        return Agents(self, None, **kwargs)
+    def agents(self, compact=None, **kwargs):
+        """
+        Fetch agents meta-data as Agent objects, or as CompactRecords keeping only the
+        fields named in compact (a tuple of field names)
+        """
+        return self._mirrored("agent", Agent, kwargs, compact) or Agents(self, None, compact=compact, **kwargs)
 
-    def agents_many(self, agent_ids):
+    def agents_many(self, agent_ids, hydrate=False):
         """Factory to create lots of Agent objects from a list of agent ids"""
-        return [Agent(self, agent_id) for agent_id in agent_ids]
+        return self._many(Agent, agent_ids, hydrate)
 
     def audit_records(self, **kwargs):
         """Fetch agents meta-data"""
         return AuditRecords(self, None, **kwargs)
 
-    def audit_records_many(self, audit_record_ids):
-        return [AuditRecord(self, audit_record_id) for audit_record_id in audit_record_ids]
+    def audit_records_many(self, audit_record_ids, hydrate=False):
+        return self._many(AuditRecord, audit_record_ids, hydrate)
 
     def bundle(self, item_id):
-        return Bundle(self, item_id)
+        return self.entity(Bundle, item_id)
 
     def bundles(self, **kwargs):
         """Fetch bundle meta-data as Bundle objects"""
         return Bundles(self, None, **kwargs)
 
-    def bundles_many(self, bundle_ids):
+    def bundles_many(self, bundle_ids, hydrate=False):
         """Factory to create lots of Bundle objects from a list of bundle ids"""
-        return [Bundle(self, bundle_id) for bundle_id in bundle_ids]
+        return self._many(Bundle, bundle_ids, hydrate)
+
+    def bundle_profiles(self, bundles, workers=None):
+        """
+        Fetch the profiles of many bundles on up to workers (default page_workers) threads.
+        Returns a dictionary of bundle item_id -> Profile
+        """
+        bundles = list(bundles)
+
+        def fetch(bundle):
+            profile = bundle.profile()
+            profile.get_json()
+            return profile
+
+        return dict(zip([bundle.item_id for bundle in bundles],
+                        imap_ordered(fetch, bundles, workers or self.page_workers)))
 
     def controller(self, item_id):
         """Create a lazily initialized Controller object"""
-        return Controller(self, item_id)
+        return self.entity(Controller, item_id)
 
-    def controllers(self, **kwargs):
-        """Fetch controller meta-data as Controller objects"""
-        return Controllers(self, None, **kwargs)
+    def controllers(self, compact=None, **kwargs):
+        """Fetch controller meta-data as Controller objects, or CompactRecords (see agents)"""
+        return self._mirrored("controller", Controller, kwargs, compact) or Controllers(self, None, compact=compact, **kwargs)
 
-    def controllers_many(self, controller_ids):
+    def controllers_many(self, controller_ids, hydrate=False):
         """Easy way to create lots of lazily initialized Controller objects from a list of ids"""
-        return [Controller(self, agent_id) for agent_id in controller_ids]
+        return self._many(Controller, controller_ids, hydrate)
 
     def controller_from_upgrade_id(self, upgrade_id):
         """Get a controller from the upgrade id"""
         json_obj = self.http_get_json("/apm/acc/controllerUpgradeTask", str(upgrade_id) + "/controller")
-        return Controller(self, json_obj)
+        return self.entity(Controller, json_obj)
 
     def diagnostic_report(self, item_id):
         """Create a lazily initialized DiagnosticReport object"""
-        return DiagnosticReport(self, item_id)
+        return self.entity(DiagnosticReport, item_id)
 
     def diagnostic_reports(self, **kwargs):
         """Fetch Diagnostic Report meta-data as DiagnosticReport objects"""
@@ -430,13 +1071,60 @@ class AccApi(AccRaw):
     def diagnostic_report_tasks(self, **kwargs):
         return DiagnosticReportTasks(self, None, **kwargs)
 
-    def diagnostic_reports_many(self, report_ids):
+    def diagnostic_reports_many(self, report_ids, hydrate=False):
         """Factory to create lots of DiagnosticReport objects from a list of report ids"""
-        return [DiagnosticReport(self, report_id) for report_id in report_ids]
+        return self._many(DiagnosticReport, report_ids, hydrate)
+
+    def iter_file(self, file_id, chunk_size=FILE_CHUNK_SIZE, size=None):
+        """
+        Yield the content of the file with the given file_id chunk_size bytes at a time.
+        If size is given, raise ACCException if a different number of bytes arrives.
+        """
+        res = self.http_get("/apm/acc/file", "%s/content" % file_id, page=None)
+        received = 0
+        try:
+            while True:
+                chunk = res.read(chunk_size)
+                if not chunk:
+                    break
+                received += len(chunk)
+                yield chunk
+        finally:
+            res.close()
+
+        check_size("file %s" % file_id, received, size)
+
+    def download_file(self, file_id, filename=None, fileobj=None, size=None, progress=False):
+        """
+        Download file with the given file_id.
 
-    def download_file(self, file_id):
-        """Download file with the given file_id"""
-        return self.http_get("/apm/acc/file", "%s/content" % file_id, page=None).read()
+        With filename the content is streamed to that file (see download_to_file) and filename
+        is returned.  With fileobj it is streamed to fileobj and the number of bytes written
+        is returned.  Otherwise the content is returned as a string.
+
+        If size (FileMeta["size"]) is given, raise ACCException if the content is a different size.
+        """
+        if filename:
+            existed = os.path.exists(filename)
+            self.download_to_file("/apm/acc/file", "%s/content" % file_id, filename,
+                                  progress=progress, page=None)
+            try:
+                check_size(filename, os.path.getsize(filename), size)
+            except ACCException:
+                # Don't leave a bad download behind to be skipped next time
+                if not existed:
+                    os.remove(filename)
+                raise
+            return filename
+
+        if fileobj:
+            written = 0
+            for chunk in self.iter_file(file_id, size=size):
+                fileobj.write(chunk)
+                written += len(chunk)
+            return written
+
+        return "".join(self.iter_file(file_id, size=size))
 
     def download_controller(self, archive_type=None, filename=None):
 
@@ -448,31 +1136,96 @@ class AccApi(AccRaw):
                 archive_type = "zip"
 
         fname = "acc-controller-package.%s" % archive_type
-        res = self.http_get("/package/", fname)
 
         if not filename:
             filename = fname
 
-        write_content_to_file(res, filename)
+        return self.download_to_file("/package/", fname, filename)
+
+    def download_to_file(self, part, item_id, filename, headers=None, progress=True, **kwargs):
+        """
+        GET part/item_id and write the content to filename (see write_content_to_file),
+        unless filename already exists.
+
+        If a .part file was left behind by an interrupted download, only the remainder is
+        requested with a Range header.  Servers which don't support ranges send the whole
+        content, which then replaces the .part file.
+        """
+        if os.path.exists(filename):
+            print("Skipping writing existing:", filename)
+            return filename
+
+        headers = (headers or self.headers).copy()
+
+        part_filename = partial_filename(filename)
+        if os.path.exists(part_filename) and os.path.getsize(part_filename):
+            headers["range"] = "bytes=%d-" % os.path.getsize(part_filename)
+
+        try:
+            res = self.http_get(part, item_id, headers, **kwargs)
+        except ACCHttpException as e:
+            if e.status != httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+                raise
+
+            # The .part file is no good, start again
+            os.remove(part_filename)
+            del headers["range"]
+            res = self.http_get(part, item_id, headers, **kwargs)
+
+        write_content_to_file(res, filename, progress=progress)
 
         return filename
 
+    def download_many(self, objects, workers=DOWNLOAD_WORKERS, **kwargs):
+        """
+        Call download(**kwargs) on each of objects (Bundles, Packages, DiagnosticReports...)
+        on up to workers threads.  Yields (obj, filename, exception) in the order of objects,
+        where exception is None if the download succeeded.
+        """
+        def download(obj):
+            try:
+                return obj, obj.download(progress=workers <= 1, **kwargs), None
+            except (ACCException, IOError) as e:
+                return obj, None, e
+
+        for obj, filename, e in imap_ordered(download, objects, workers):
+            if e:
+                print("Failed to download %s %s: %s" % (obj.my_name(), obj.item_id, e))
+            else:
+                print("Downloaded", filename)
+
+            yield obj, filename, e
+
     def files(self, **kwargs):
         """Get all available files"""
         return Files(self, None, **kwargs)
 
-    def file_meta_many(self, file_ids):
-        return [FileMeta(self, file_id) for file_id in file_ids]
+    def file_meta_many(self, file_ids, hydrate=False):
+        return self._many(FileMeta, file_ids, hydrate)
 
     def package(self, item_id):
-        return Package(self, item_id)
+        return self.entity(Package, item_id)
 
     def packages(self, **kwargs):
-        return Packages(self, None, **kwargs)
+        return self._mirrored("package", Package, kwargs) or Packages(self, None, **kwargs)
 
-    def packages_many(self, package_ids):
+    def _mirrored(self, name, cls, kwargs, compact=None):
+        """
+        Return a MirroredCollection answering this request from the local inventory mirror,
+        or None if there is no mirror or the request can not be answered from it.
+        """
+        if not self.mirror:
+            return None
+
+        try:
+            return MirroredCollection(self, self.mirror, name, cls, compact=compact, **kwargs)
+        except ACCMirrorQueryException as e:
+            debug("not using inventory mirror: %s" % e)
+            return None
+
+    def packages_many(self, package_ids, hydrate=False):
         """Factory to create lots of Package objects from a list of package ids"""
-        return [Package(self, package_id) for package_id in package_ids]
+        return self._many(Package, package_ids, hydrate)
 
     def package_create(self, name, os, appserver, em_host, agent_version, process_display_name, comment, draft):
 
@@ -490,69 +1243,758 @@ class AccApi(AccRaw):
         # The returned json is a package
         return self.package(package_json)
 
+    def package_builder(self, name, os, appserver, em_host, agent_version, process_display_name, comment):
+        """Create a PackageBuilder, to assemble a new package with bundles and overrides in as few requests as possible"""
+        return PackageBuilder(self, name, os, appserver, em_host, agent_version, process_display_name, comment)
+
+    def file_push(self, file_id, destination, operation="COPY", workers=CONCURRENCY, rate=None):
+        """Create a FilePush, to copy an uploaded file to many agents at once"""
+        return FilePush(self, file_id, destination, operation, workers, rate)
+
+    def diagnostic_report_pipeline(self, create=None, create_workers=REPORT_WORKERS,
+                                   download_workers=DOWNLOAD_WORKERS, timeout_seconds=TASK_TIMEOUT):
+        """Create a DiagnosticReportPipeline, to create and download the diagnostic reports of many agents"""
+        return DiagnosticReportPipeline(self, create, create_workers, download_workers, timeout_seconds)
+
+    def log_level_update(self, value, workers=CONCURRENCY, rate=None):
+        """Create a LogLevelUpdate, to set the log level of many agents at once"""
+        return LogLevelUpdate(self, value, workers, rate)
+
     def security_tokens(self, **kwargs):
         return SecurityTokens(self, None, **kwargs)
 
-    def security_tokens_many(self, sec_ids):
-        return [SecurityToken(self, sec_id) for sec_id in sec_ids]
+    def security_tokens_many(self, sec_ids, hydrate=False):
+        return self._many(SecurityToken, sec_ids, hydrate)
 
-    def upload_file(self, filename):
+    def _many(self, cls, item_ids, hydrate):
+        """
+        Create lazily initialized objects of type cls for the item ids.
+        If hydrate is True fetch them all up front with hydrate() rather than one at a time on first use.
+        """
+        objects = [self.entity(cls, item_id) for item_id in item_ids]
+
+        if hydrate:
+            self.hydrate(objects)
+
+        return objects
+
+    def hydrate(self, objects, refresh=False, workers=None):
+        """
+        Fetch the json for many lazily initialized objects in as few requests as possible.
+
+        Objects whose type supports it are fetched a page_size batch at a time with a
+        filtered list call (q=id:(1 OR 2 ...)).  Anything not resolved that way is fetched
+        with individual GETs on up to workers (default page_workers) threads.
+
+        Objects which already have json are skipped unless refresh is True.  If an object
+        can not be fetched it is left lazy, so the error is raised when it is first used
+        just as it would have been without hydrating.
+        Returns the list of objects.
+        """
+        objects = list(objects)
+        pending = [obj for obj in objects if refresh or not obj.json]
+
+        resolved = set()
+
+        by_url = collections.OrderedDict()
+        for obj in pending:
+            if obj.supports_id_query:
+                by_url.setdefault((obj.my_url(), obj.my_name()), []).append(obj)
+
+        for (url, name), group in by_url.iteritems():
+            if url in self.id_query_unsupported:
+                continue
+
+            for i in xrange(0, len(group), self.page_size):
+                batch = group[i:i + self.page_size]
+                query = "id:(%s)" % " OR ".join([str(obj.item_id) for obj in batch])
+
+                try:
+                    json_obj = self.http_get_json("/apm/acc/%s" % url, None, q=query, page=0, size=len(batch))
+                except ACCHttpException as e:
+                    debug("id query on %s failed (%s), fetching individually" % (url, e))
+                    self.id_query_unsupported.add(url)
+                    break
+
+                found = dict((str(item["id"]), item) for item in json_obj.get("_embedded", {}).get(name, []))
+
+                for obj in batch:
+                    item = found.get(str(obj.item_id))
+                    if item is not None:
+                        obj.json = item
+                        resolved.add(id(obj))
+
+        def fetch(obj):
+            old_json, obj.json = obj.json, None
+            try:
+                obj.get_json()
+            except ACCHttpException as e:
+                debug("could not fetch %s %s: %s" % (obj.my_name(), obj.item_id, e))
+                obj.json = old_json
+
+        remaining = [obj for obj in pending if id(obj) not in resolved]
+
+        for _ in imap_ordered(fetch, remaining, workers or self.page_workers):
+            pass
+
+        return objects
+
+    def upload_file(self, filename, progress=None):
+        """
+        Upload a file, streaming it from disk. progress is an optional callback,
+        see MultipartBody and progress_printer.
+        """
         fields = [("name", os.path.basename(filename)),
                   ("modified", datetime.datetime.utcfromtimestamp(os.path.getmtime(filename)).isoformat())]
-        files = [
-            ("file", os.path.basename(filename), open(filename, "rb").read())]
 
-        res, json_obj = self.http_post_multipart("/apm/acc/file", fields, files)
+        with open(filename, "rb") as fin:
+            files = [("file", os.path.basename(filename), fin)]
+
+            res, json_obj = self.http_post_multipart("/apm/acc/file", fields, files, progress)
 
         return GenericJsonObject(self, json_obj)
 
     def upgrade_status(self):
         return ControllerUpgradeStatus(self, None)
 
-    def wait_for_tasks(self, tasks, id_field="id", include_failed=True, timeout_seconds=30, loop_pause_seconds=3):
+    def wait_for_tasks(self, tasks, id_field="id", include_failed=True, timeout_seconds=30, loop_pause_seconds=3,
+                       max_pause_seconds=30, backoff=1.5):
         """
-        Generic task waiter/yielder (generator) utility
+        Generic task waiter/yielder (generator) utility. Tasks are yielded as soon as they
+        complete (or fail, if include_failed). See TaskWaiter.
         """
+        return iter(TaskWaiter(self, tasks, id_field=id_field, include_failed=include_failed,
+                               timeout_seconds=timeout_seconds, min_pause_seconds=loop_pause_seconds,
+                               max_pause_seconds=max_pause_seconds, backoff=backoff))
+
+
+class TaskWaiter(object):
+
+    """
+    Poll tasks (upgrade tasks, diagnostic report tasks...) until they complete or fail,
+    yielding each one as soon as it does.
 
-        print("Waiting for tasks")
+    Each round, all tasks which are due a poll are refreshed together with AccApi.hydrate,
+    i.e. with one filtered list call per task type where the server supports it, otherwise
+    with concurrent individual GETs.  Each task is then re-polled after its own delay, which
+    starts at min_pause_seconds and grows by backoff up to max_pause_seconds.  Once some tasks
+    have completed, a task which has not yet been waited for as long as the typical (median)
+    completed task is polled when it would be expected to complete, if that is sooner.
 
-        timeout = time.time() + timeout_seconds
+    If a task is not done timeout_seconds after it was first polled, it is yielded (if
+    include_failed) in whatever state it was last seen.
 
-        remaining_tasks = []
+    If more is True, further tasks can be added from other threads with add() while iterating,
+    which carries on until close() is called and all the tasks are done.
+    """
 
-        while time.time() < timeout:
-            remaining_tasks = []
+    def __init__(self, accapi, tasks, id_field="id", include_failed=True, timeout_seconds=30,
+                 min_pause_seconds=3, max_pause_seconds=30, backoff=1.5, workers=None, more=False):
+        self.accapi = accapi
+        self.tasks = list(tasks)
+        self.incoming = collections.deque(self.tasks)
+        self.more = more
+        self.cond = threading.Condition()
+        self.id_field = id_field
+        self.include_failed = include_failed
+        self.timeout_seconds = float(timeout_seconds)
+        self.min_pause_seconds = float(min_pause_seconds)
+        self.max_pause_seconds = max(float(max_pause_seconds), self.min_pause_seconds)
+        self.backoff = backoff
+        self.workers = workers
+
+        # How long the tasks which have completed took, used to predict the others
+        self.durations = []
+
+    def add(self, task):
+        """Start waiting for another task, see more"""
+        with self.cond:
+            self.incoming.append(task)
+            self.cond.notify()
+
+    def close(self):
+        """No more tasks will be added"""
+        with self.cond:
+            self.more = False
+            self.cond.notify()
+
+    def expected_duration(self):
+        if not self.durations:
+            return None
+        return sorted(self.durations)[len(self.durations) // 2]
+
+    def next_poll(self, now, started, delay):
+        """When to poll a task next, given when we started waiting for it and its current delay"""
+        next_poll = now + delay
+
+        expected = self.expected_duration()
+        if expected is not None and now - started < expected:
+            next_poll = min(next_poll, max(started + expected, now + self.min_pause_seconds))
+
+        return next_poll
 
-            print("Have %d tasks to poll, %d remaining tasks" %(len(tasks), len(remaining_tasks)))
-            for task in tasks:
-                # print(task)
+    def __iter__(self):
+        if self.tasks:
+            print("Waiting for %d tasks" % len(self.tasks))
 
-                # print("id is", task.item_id)
-                task.json = None # force a refresh of the task
-                print(task[id_field], task["status"])
+        # [task, next poll time, current delay, when we started waiting for it]
+        remaining = []
 
-                if task["status"] in [TASK_COMPLETED]:
+        while True:
+            now = time.time()
+
+            with self.cond:
+                # The first poll of a new task is made straight away
+                while self.incoming:
+                    remaining.append([self.incoming.popleft(), now, self.min_pause_seconds, now])
+
+                if not remaining:
+                    if not self.more:
+                        break
+                    self.cond.wait()
+                    continue
+
+            timed_out = [state for state in remaining if now >= state[3] + self.timeout_seconds]
+            if timed_out:
+                print("%d tasks did not complete in time" % len(timed_out))
+                remaining = [state for state in remaining if now < state[3] + self.timeout_seconds]
+
+                if self.include_failed:
+                    # yield the tasks that got left out
+                    for state in timed_out:
+                        yield state[0]
+                continue
+
+            due = [state for state in remaining if state[1] <= now]
+            due_ids = set(id(state) for state in due)
+
+            if not due:
+                wake = min(min(state[1], state[3] + self.timeout_seconds) for state in remaining)
+                with self.cond:
+                    # Sleep until the next poll, unless a task is added
+                    if not self.incoming:
+                        self.cond.wait(max(0, wake - now))
+                continue
+
+            debug("polling %d of %d remaining tasks" % (len(due), len(remaining)))
+            self.accapi.hydrate([state[0] for state in due], refresh=True, workers=self.workers)
+
+            now = time.time()
+            still_remaining = []
+
+            for state in remaining:
+                task, next_poll, delay, started = state
+
+                if id(state) not in due_ids:
+                    still_remaining.append(state)
+                    continue
+
+                status = task["status"]
+
+                if status == TASK_COMPLETED:
+                    self.durations.append(now - started)
+                    print(task[self.id_field], status)
                     yield task
-                elif task in [TASK_FAILED]:
-                    if include_failed:
+                elif status == TASK_FAILED:
+                    print(task[self.id_field], status)
+                    if self.include_failed:
                         yield task
                 else:
-                    remaining_tasks.append(task)
+                    state[2] = min(delay * self.backoff, self.max_pause_seconds)
+                    state[1] = self.next_poll(now, started, delay)
+                    still_remaining.append(state)
 
-            print("Remaining tasks is", len(remaining_tasks))
+            remaining = still_remaining
 
-            if not remaining_tasks:
-                break
 
-            tasks = remaining_tasks
+class RateLimiter(object):
+
+    """Spread out calls to wait(), across all threads, so that they return no more than rate times a second"""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.time()
+            when = max(now, self.next_time)
+            self.next_time = when + self.interval
+
+        if when > now:
+            time.sleep(when - now)
+
+
+class AgentTaskResult(object):
+
+    """What happened to the task run on one agent, see AgentTasks"""
+
+    __slots__ = ("agent", "task", "status", "error")
+
+    def __init__(self, agent, task=None, status=None, error=None):
+        self.agent = agent
+        self.task = task
+        self.status = status
+        self.error = error
+
+    def __repr__(self):
+        return "AgentTaskResult(agent=%s, task=%s, status=%s, error=%s)" % (
+            self.agent.item_id, self.task.item_id if self.task else None, self.status, self.error)
+
+
+class AgentTasks(object):
+
+    """
+    Run a task (copying a file, setting the log level...) on many agents.
+
+    submit() creates the task for each agent by calling create_task(agent), which returns the
+    task object, with up to workers requests in flight and, if rate is given, no more than rate
+    requests started a second.  wait() then polls all the tasks together (see TaskWaiter) until
+    the agents have completed or failed them.
+
+    results maps each agent id to its AgentTaskResult, whose status is SUBMITTED once the task
+    has been created, then the status of the task (COMPLETED, FAILED), or ERROR if the task could
+    not be created and TIMEOUT if it did not finish in time.  timings holds how long submit and
+    wait took.
+    """
+
+    def __init__(self, accapi, create_task, workers=CONCURRENCY, rate=None):
+        self.accapi = accapi
+        self.create_task = create_task
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.results = collections.OrderedDict()
+        self.timings = collections.OrderedDict()
+
+        accapi.ensure_pool_size(workers)
+
+    def _submit_one(self, agent):
+        self.limiter.wait()
+        try:
+            task = self.create_task(agent)
+        except ACCException as e:
+            return AgentTaskResult(agent, status="ERROR", error=e)
+
+        return AgentTaskResult(agent, task, "SUBMITTED")
+
+    def submit(self, agents):
+        """Create the task for each of agents, yielding each AgentTaskResult in turn"""
+        started = time.time()
+        try:
+            for result in imap_ordered(self._submit_one, agents, self.workers):
+                self.results[str(result.agent.item_id)] = result
+                if result.error:
+                    print("Failed to create task for agent %s: %s" % (result.agent.item_id, result.error))
+
+                yield result
+        finally:
+            self.timings["submit"] = time.time() - started
+
+    def wait(self, timeout_seconds=TASK_TIMEOUT, **kwargs):
+        """
+        Wait for the submitted tasks to finish, yielding each AgentTaskResult as its task completes
+        or fails, then any that timed out.  kwargs are passed to TaskWaiter.
+        """
+        results = dict((id(result.task), result) for result in self.results.values() if result.task)
+
+        waiter = TaskWaiter(self.accapi, [result.task for result in results.values()],
+                            timeout_seconds=timeout_seconds, workers=self.workers, **kwargs)
+
+        started = time.time()
+        try:
+            for task in waiter:
+                result = results[id(task)]
+                status = task.get_json().get("status")
+                result.status = status if status in (TASK_COMPLETED, TASK_FAILED) else "TIMEOUT"
+                yield result
+        finally:
+            self.timings["wait"] = time.time() - started
+
+    def summary(self):
+        """Number of agents by status"""
+        return collections.Counter(result.status for result in self.results.values())
+
+    def failures(self):
+        """Number of agents the task could not be created for, failed on or did not finish in time"""
+        summary = self.summary()
+        return summary["ERROR"] + summary[TASK_FAILED] + summary["TIMEOUT"]
+
+    def report(self):
+        """One line summary of the outcome and how long it took"""
+        return "%d agents: %s (%s)" % (
+            len(self.results),
+            ", ".join("%s %d" % (status, count) for status, count in sorted(self.summary().items())),
+            ", ".join("%s %.1fs" % (stage, secs) for stage, secs in self.timings.items()))
+
+
+class FilePush(AgentTasks):
+
+    """
+    Copy (or otherwise operate on) an uploaded file on many agents with an agentFileOperationTask each,
+    see AgentTasks.
+    """
+
+    def __init__(self, accapi, file_id, destination, operation="COPY", workers=CONCURRENCY, rate=None):
+        super(FilePush, self).__init__(accapi, self.copy_file, workers, rate)
+        self.file_id = file_id
+        self.destination = destination
+        self.operation = operation
+
+    def copy_file(self, agent):
+        return agent.agent_file_operation_task(self.file_id, self.destination, self.operation)
+
+
+class LogLevelUpdate(AgentTasks):
+
+    """
+    Set the log level of many agents with an agentUpdateTask each, see AgentTasks.
+    The task of each result is the AgentUpdateTask, whose item_id is the update id.
+    """
+
+    def __init__(self, accapi, value, workers=CONCURRENCY, rate=None):
+        super(LogLevelUpdate, self).__init__(accapi, self.set_log_level, workers, rate)
+        self.value = value
+
+    def set_log_level(self, agent):
+        return agent.set_log_level(self.value)
+
+
+class ReportResult(object):
+
+    """What happened creating and downloading the diagnostic report of one agent, see DiagnosticReportPipeline"""
+
+    __slots__ = ("agent", "task", "filename", "status", "error", "timings")
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.task = None
+        self.filename = None
+        self.status = None
+        self.error = None
+        self.timings = collections.OrderedDict()
+
+    def __repr__(self):
+        return "ReportResult(agent=%s, task=%s, status=%s, filename=%s, error=%s)" % (
+            self.agent.item_id, self.task.item_id if self.task else None, self.status, self.filename, self.error)
+
+
+class DiagnosticReportPipeline(object):
+
+    """
+    Create and download the diagnostic reports of many agents with the stages overlapping:
+    each report is downloaded as soon as its task completes, while the tasks of other agents
+    are still being created or polled.
+
+    Up to create_workers tasks are created at once by calling create(agent), which returns a
+    DiagnosticReportTask, or None to skip the agent (the default always creates a new report).
+    The tasks are all polled by one TaskWaiter (kwargs are passed to it), each for up to
+    timeout_seconds, and the reports are downloaded download_workers at a time.
+
+    run() yields a ReportResult for each agent as it finishes, with status COMPLETED, SKIPPED,
+    ERROR (the task could not be created), FAILED, TIMEOUT or DOWNLOAD_FAILED, and the time
+    spent in each stage.  report() summarises the stage latencies.
+    """
+
+    def __init__(self, accapi, create=None, create_workers=REPORT_WORKERS, download_workers=DOWNLOAD_WORKERS,
+                 timeout_seconds=TASK_TIMEOUT, **kwargs):
+        self.accapi = accapi
+        self.create = create or (lambda agent: agent.create_diagnostic_report())
+        self.create_workers = create_workers
+        self.download_workers = download_workers
+        self.waiter = TaskWaiter(accapi, [], timeout_seconds=timeout_seconds, more=True, **kwargs)
+        self.results = []
+        self.elapsed = None
+
+        # id(task) -> (ReportResult, when the task was handed to the waiter)
+        self.waiting = {}
+
+        accapi.ensure_pool_size(create_workers + download_workers)
+
+    def _create(self, agent):
+        result = ReportResult(agent)
+        started = time.time()
+        try:
+            result.task = self.create(agent)
+            if not result.task:
+                result.status = "SKIPPED"
+        except ACCException as e:
+            result.status = "ERROR"
+            result.error = e
+
+        result.timings["create"] = time.time() - started
+        return result
+
+    def _download(self, result, done):
+        started = time.time()
+        try:
+            result.filename = result.task.get_report().download(progress=False)
+            result.status = TASK_COMPLETED
+        except (ACCException, IOError) as e:
+            result.status = "DOWNLOAD_FAILED"
+            result.error = e
+
+        result.timings["download"] = time.time() - started
+        done.put(result)
+
+    def _create_stage(self, agents, done):
+        try:
+            for result in imap_ordered(self._create, agents, self.create_workers):
+                self.results.append(result)
+                if result.task:
+                    self.waiting[id(result.task)] = (result, time.time())
+                    self.waiter.add(result.task)
+                else:
+                    done.put(result)
+        except Exception as e:
+            done.put(e)
+        finally:
+            self.waiter.close()
+
+    def _wait_stage(self, done):
+        pool = ThreadPool(self.download_workers)
+        try:
+            for task in self.waiter:
+                result, added = self.waiting.pop(id(task))
+                result.timings["wait"] = time.time() - added
+
+                status = task.get_json().get("status")
+                if status == TASK_COMPLETED:
+                    pool.apply_async(self._download, (result, done))
+                else:
+                    result.status = status if status == TASK_FAILED else "TIMEOUT"
+                    done.put(result)
+        except Exception as e:
+            done.put(e)
+        finally:
+            pool.close()
+            pool.join()
+            done.put(None)
+
+    def run(self, agents):
+        """Create, wait for and download the reports of agents, yielding each ReportResult as it finishes"""
+        started = time.time()
+        done = Queue.Queue()
+
+        for target, args in ((self._create_stage, (agents, done)), (self._wait_stage, (done,))):
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                try:
+                    # (With a timeout so that Ctrl-C is not blocked)
+                    result = done.get(True, 1)
+                except Queue.Empty:
+                    continue
+
+                if result is None:
+                    break
+                if isinstance(result, Exception):
+                    raise result
+
+                yield result
+        finally:
+            self.elapsed = time.time() - started
+
+    def summary(self):
+        """Number of agents by status"""
+        return collections.Counter(result.status for result in self.results)
+
+    def failures(self):
+        """Number of agents whose report could not be created, did not complete or could not be downloaded"""
+        summary = self.summary()
+        return summary["ERROR"] + summary[TASK_FAILED] + summary["TIMEOUT"] + summary["DOWNLOAD_FAILED"]
+
+    def report(self):
+        """Outcome and median/maximum latency of each stage"""
+        lines = ["%d agents: %s" % (len(self.results),
+                                    ", ".join("%s %d" % (status, count)
+                                              for status, count in sorted(self.summary().items())))]
+
+        for stage in ("create", "wait", "download"):
+            secs = sorted(result.timings[stage] for result in self.results if stage in result.timings)
+            if secs:
+                lines.append("%s: %d, median %.1fs, max %.1fs" % (stage, len(secs), secs[len(secs) // 2], secs[-1]))
+
+        if self.elapsed is not None:
+            lines.append("total: %.1fs" % self.elapsed)
+
+        return "\n".join(lines)
+
 
-            print("sleep")
-            time.sleep(loop_pause_seconds)
+class AsyncAccApi(object):
 
-        if include_failed:
-            # yield any remaining tasks that got left out
-            for task in remaining_tasks:
-                yield task
+    """
+    Non-blocking counterpart of AccApi for fleet wide operations, e.g. setting the log
+    level of thousands of agents with hundreds of requests in flight.
+
+    Each call is run on a shared pool of concurrency threads, which is the global limit on
+    the number of requests in flight, and immediately returns a future (a
+    multiprocessing.pool.AsyncResult: call get() for the result, or use as_completed/wait).
+    Iterating over a collection such as agents() blocks, but its pages are fetched concurrently.
+
+    (The library targets python 2.7 so this is built on threads rather than asyncio.)
+    """
+
+    def __init__(self, accapi, concurrency=CONCURRENCY):
+        self.accapi = accapi
+        self.concurrency = concurrency
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def _get_pool(self):
+        with self.lock:
+            if not self.pool:
+                self.accapi.ensure_pool_size(self.concurrency)
+                self.pool = ThreadPool(self.concurrency)
+        return self.pool
+
+    def close(self):
+        """Wait for outstanding calls to finish and stop the worker threads"""
+        with self.lock:
+            pool, self.pool = self.pool, None
+
+        if pool:
+            pool.close()
+            pool.join()
+
+    def submit(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on the pool, returning a future"""
+        return self._get_pool().apply_async(func, args, kwargs)
+
+    def map(self, func, items, window=None):
+        """
+        Yield func(item) for each item, in order, with up to concurrency calls in flight
+        (or window calls ahead of the consumer if given)
+        """
+        return imap_ordered(func, items, self.concurrency, window or self.concurrency * 2, pool=self._get_pool())
+
+    # noinspection PyMethodMayBeStatic
+    def as_completed(self, futures, poll_seconds=0.1):
+        """Yield the futures as they complete, whatever order they were submitted in"""
+        pending = list(futures)
+        while pending:
+            still_pending = []
+            for future in pending:
+                if future.ready():
+                    yield future
+                else:
+                    still_pending.append(future)
+
+            pending = still_pending
+            if pending:
+                pending[0].wait(poll_seconds)
+
+    # noinspection PyMethodMayBeStatic
+    def wait(self, futures):
+        """Wait for all the futures and return their results (re-raising the first failure)"""
+        return [future.get() for future in futures]
+
+    # noinspection PyMethodMayBeStatic
+    def _fetched(self, obj):
+        obj.get_json()
+        return obj
+
+    def _fetch(self, obj):
+        return self.submit(self._fetched, obj)
+
+    def agent(self, item_id):
+        return self._fetch(self.accapi.agent(item_id))
+
+    def agents(self, **kwargs):
+        return self.accapi.agents(**kwargs)
+
+    def agents_many(self, agent_ids):
+        return [self.agent(agent_id) for agent_id in agent_ids]
+
+    def bundle(self, item_id):
+        return self._fetch(self.accapi.bundle(item_id))
+
+    def bundles(self, **kwargs):
+        return self.accapi.bundles(**kwargs)
+
+    def controller(self, item_id):
+        return self._fetch(self.accapi.controller(item_id))
+
+    def controllers(self, **kwargs):
+        return self.accapi.controllers(**kwargs)
+
+    def controllers_many(self, controller_ids):
+        return [self.controller(controller_id) for controller_id in controller_ids]
+
+    def diagnostic_report(self, item_id):
+        return self._fetch(self.accapi.diagnostic_report(item_id))
+
+    def diagnostic_reports(self, **kwargs):
+        return self.accapi.diagnostic_reports(**kwargs)
+
+    def diagnostic_report_tasks(self, **kwargs):
+        return self.accapi.diagnostic_report_tasks(**kwargs)
+
+    def package(self, item_id):
+        return self._fetch(self.accapi.package(item_id))
+
+    def packages(self, **kwargs):
+        return self.accapi.packages(**kwargs)
+
+    def hydrate(self, objects, refresh=False):
+        return self.submit(self.accapi.hydrate, objects, refresh, self.concurrency)
+
+    def set_log_level(self, agent, value):
+        """Future of the AgentUpdateTask, whose item_id is the update id"""
+        return self.submit(agent.set_log_level, value)
+
+    def copy_file(self, agent, file_id, destination):
+        return self.submit(agent.copy_file, file_id, destination)
+
+    def create_diagnostic_report(self, agent):
+        """Future of the DiagnosticReportTask"""
+        return self.submit(agent.create_diagnostic_report)
+
+    def upgrade(self, controller):
+        """Future of the upgrade TaskStatus"""
+        return self.submit(controller.upgrade)
+
+    def task_status(self, task):
+        """Future of the task, refreshed from the server"""
+        def refresh():
+            task.json = None
+            task.get_json()
+            return task
+
+        return self.submit(refresh)
+
+    def download(self, obj, *args, **kwargs):
+        """Future of the filename written by obj.download (a Bundle, Package or DiagnosticReport)"""
+        return self.submit(obj.download, *args, **kwargs)
+
+    def download_file(self, file_id, *args, **kwargs):
+        return self.submit(self.accapi.download_file, file_id, *args, **kwargs)
+
+    def upload_file(self, filename, progress=None):
+        return self.submit(self.accapi.upload_file, filename, progress)
+
+
+def read_json_file(filename):
+    """The json in filename, or {} if it does not exist (yet) or can't be read"""
+    try:
+        with open(filename, "rb") as fin:
+            return json.load(fin)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_json_file(filename, json_obj):
+    """Write json_obj to filename atomically, so readers never see a partly written file"""
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or ".")
+    with os.fdopen(fd, "wb") as fout:
+        json.dump(json_obj, fout)
+    os.rename(tmp_filename, filename)
 
 
 class AccEnv(object):
@@ -569,6 +2011,9 @@ class AccEnv(object):
 
         self.config_dir = os.path.join(self.home, '.acc')
 
+        # Local data kept between runs (e.g. the inventory mirror)
+        self.cache_dir = os.path.join(self.config_dir, 'cache')
+
         # Will be dictionary of config dictionaries (or for each profile)
         self.config = {}
 
@@ -657,6 +2102,17 @@ class AccEnv(object):
     def profile_path(self, profile):
         return os.path.join(self.config_dir, profile)
 
+    def cache_path(self, filename):
+        """Path to a file in the cache directory, creating the directory if needed"""
+        if not os.path.exists(self.cache_dir):
+            debug("creating cache dir %s" % self.cache_dir)
+            os.makedirs(self.cache_dir, 0o700)
+
+        return os.path.join(self.cache_dir, filename)
+
+    def mirror_path(self):
+        return self.cache_path("%s-inventory.db" % (self.profile or "default"))
+
     def write_config(self, profile):
         if not os.path.exists(self.config_dir):
             debug("creating config dir %s" % self.config_dir)
@@ -736,6 +2192,12 @@ class FetchableJsonObject(GenericJsonObject):
     A json fragment such as Page does not have a mapping to an API call
     so that would be a plain GenericJsonObject
     """
+    # True if the collection for this type can be filtered on id, see AccApi.hydrate
+    supports_id_query = False
+
+    # True if json only holds some fields (see PagedJsonObject), so any others must be fetched
+    partial = False
+
     def __init__(self, accapi, json_obj_or_item_id):
         super(FetchableJsonObject, self).__init__(accapi, None)
 
@@ -751,6 +2213,13 @@ class FetchableJsonObject(GenericJsonObject):
             self.json = self.accapi.http_get_json("/apm/acc/%s" % self.my_url(), self.item_id)
         return self.json
 
+    def __getitem__(self, key):
+        if self.partial and key not in self.get_json():
+            # Fetch the whole object
+            self.partial = False
+            self.json = None
+        return super(FetchableJsonObject, self).__getitem__(key)
+
     def my_url(self):
         return self.my_name()
 
@@ -760,10 +2229,22 @@ class FetchableJsonObject(GenericJsonObject):
 
 class PagedJsonObject(GenericJsonObject):
 
-    def __init__(self, accapi, json_obj=None, **kwargs):
+    def __init__(self, accapi, json_obj=None, compact=None, fields=None, **kwargs):
         super(PagedJsonObject, self).__init__(accapi, json_obj, **kwargs)
         self.page = Page(json_obj)
 
+        # Only keep these fields of each item. The server is asked for just these where it supports it,
+        # and anything else (e.g. _links) is dropped as the items are made.  Other fields of an item
+        # are fetched if they are asked for.
+        self.fields = frozenset(fields or compact or ())
+
+        # Yield CompactRecords of these fields rather than full objects
+        self.layout = None
+        if compact:
+            if not self.item_class():
+                raise ACCException("%s does not support compact mode" % type(self).__name__)
+            self.layout = CompactLayout(accapi, self.item_class(), compact)
+
     # noinspection PyMethodOverriding
     def get_json(self, item_id, page=None):
 
@@ -775,7 +2256,7 @@ class PagedJsonObject(GenericJsonObject):
         else:
             args = self.extra_args
 
-        self.json = self.accapi.http_get_json("/apm/acc/%s" % self.my_url(), item_id, **args)
+        self.json = self.http_get_json(item_id, args)
 
         # Only try and save the page if this is a paged call
         if page is not None:
@@ -794,10 +2275,54 @@ class PagedJsonObject(GenericJsonObject):
     def new_item(self, json_obj):
         return GenericJsonObject(self.accapi, json_obj)
 
+    # noinspection PyMethodMayBeStatic
+    def item_class(self):
+        """The FetchableJsonObject type of the items, needed for compact mode"""
+        return None
+
+    def fetch_page(self, page):
+        """
+        Fetch and return the json for one page without updating this object,
+        so pages can be fetched concurrently.
+        """
+        args = self.extra_args.copy()
+        args["page"] = page
+        return self.http_get_json(None, args)
+
+    def http_get_json(self, item_id, args):
+        """GET from this collection, asking for just our fields if the server supports projections"""
+        url = "/apm/acc/%s" % self.my_url()
+
+        if self.fields and url not in self.accapi.projection_unsupported:
+            try:
+                return self.accapi.http_get_json(url, item_id, fields=",".join(sorted(self.fields)), **args)
+            except ACCHttpException as e:
+                if e.status != httplib.BAD_REQUEST:
+                    raise
+                debug("%s does not support fields (%s)" % (url, e))
+                self.accapi.projection_unsupported.add(url)
+
+        return self.accapi.http_get_json(url, item_id, **args)
+
+    def project_item(self, json_obj):
+        """Make an item from its json, keeping only our fields if we have some"""
+        if self.layout:
+            return CompactRecord(self.layout, json_obj)
+
+        if not self.fields:
+            return self.new_item(json_obj)
+
+        json_obj = project(json_obj, self.fields)
+        item = self.new_item(json_obj)
+
+        if item.json is json_obj:
+            item.partial = True
+
+        return item
+
     def my_items(self):
         for item in self.json["_embedded"][self.my_name()]:
-            x = self.new_item(item)
-            yield x
+            yield self.project_item(item)
 
     def __iter__(self):
         """
@@ -805,6 +2330,10 @@ class PagedJsonObject(GenericJsonObject):
         just sees a constant stream of agents/controllers etc.
         If a page is specified in the keyword arguments then
         only that page of data is returned.
+
+        Once the first page tells us how many pages there are, the remaining
+        pages are prefetched on accapi.page_workers threads while the caller
+        is consuming the items of earlier pages.
         """
         page_specified = self.extra_args.get("page")
 
@@ -816,7 +2345,37 @@ class PagedJsonObject(GenericJsonObject):
             debug("have a page arg: %s" % page_number)
             page_specified = True
 
-        while True:
+        self.get_json(None, page_number)
+
+        if not self.page.has_data():
+            return
+
+        for x in self.my_items():
+            yield x
+
+        if page_specified or self.page.is_last_page():
+            return
+
+        total_pages = self.page["totalPages"]
+
+        for json_obj in imap_ordered(self.fetch_page, xrange(page_number + 1, total_pages),
+                                     self.accapi.page_workers):
+            page = Page(json_obj)
+
+            if not page.has_data():
+                # The collection has shrunk since the first page was fetched
+                return
+
+            self.json, self.page = json_obj, page
+
+            for x in self.my_items():
+                yield x
+
+        # The collection may have grown since the first page was fetched, so carry on a page at a time
+        page_number = total_pages - 1
+
+        while not self.page.is_last_page():
+            page_number += 1
             self.get_json(None, page_number)
 
             if not self.page.has_data():
@@ -825,10 +2384,6 @@ class PagedJsonObject(GenericJsonObject):
             for x in self.my_items():
                 yield x
 
-            if page_specified or self.page.is_last_page():
-                break
-            page_number += 1
-
     def __getitem__(self, key):
         """
         For a PagedJsonObject we will make an API call for the id
@@ -839,9 +2394,9 @@ class PagedJsonObject(GenericJsonObject):
         if isinstance(key, slice):
             raise Exception("Can't handle slices")
         elif isinstance(key, int):
-            r = self.new_item(self.get_json(str(key)))
+            r = self.project_item(self.get_json(str(key)))
         else:
-            r = self.new_item(self.get_json(key))
+            r = self.project_item(self.get_json(key))
 
         return r
 
@@ -858,9 +2413,74 @@ class Page(GenericJsonObject):
         # self.json["totalElements"]
         return self.json["number"] < self.json["totalPages"]
 
-    def is_last_page(self):
-        """Return True if this is the last page"""
-        return self.json["number"] == self.json["totalPages"] - 1
+    def is_last_page(self):
+        """Return True if this is the last page"""
+        return self.json["number"] == self.json["totalPages"] - 1
+
+
+class CompactLayout(object):
+
+    """The fields kept by the CompactRecords of a collection, shared by all its records"""
+
+    def __init__(self, accapi, cls, fields):
+        self.accapi = accapi
+        self.cls = cls
+        self.fields = tuple(fields)
+        self.index = dict((name, i) for i, name in enumerate(self.fields))
+
+
+class CompactRecord(object):
+
+    """
+    A small, read only, stand in for an Agent, Controller etc. which keeps only the fields
+    of its CompactLayout, in a tuple, rather than the whole json object.  Used when holding
+    large inventories in memory, e.g. acc.agents(compact=("id", "agentName", "status")).
+
+    Asking for any other field, or calling methods of the full object (e.g. set_log_level),
+    fetches the full object from the server the first time it is needed.
+    """
+
+    __slots__ = ("layout", "item_id", "values", "full")
+
+    missing = object()
+
+    def __init__(self, layout, json_obj):
+        self.layout = layout
+        self.item_id = json_obj["id"]
+        self.values = tuple(json_obj.get(name, CompactRecord.missing) for name in layout.fields)
+        self.full = None
+
+    def get_full(self):
+        """Return the full object for this record"""
+        if self.full is None:
+            self.full = self.layout.accapi.entity(self.layout.cls, self.item_id)
+        return self.full
+
+    def get_json(self):
+        return self.get_full().get_json()
+
+    def __getitem__(self, key):
+        index = self.layout.index.get(key)
+
+        if index is None or self.values[index] is CompactRecord.missing:
+            return self.get_full()[key]
+
+        value = self.values[index]
+        if hasattr(value, "encode"):
+            # Handle unicode characters, as GenericJsonObject does
+            return value.encode("UTF-8")
+        return value
+
+    def __getattr__(self, name):
+        # Only called for attributes which are not slots, e.g. methods of the full object
+        return getattr(self.get_full(), name)
+
+    def __str__(self):
+        return pprint.PrettyPrinter(indent=2).pformat(
+            dict((name, value) for name, value in zip(self.layout.fields, self.values) if value is not CompactRecord.missing))
+
+    def __repr__(self):
+        return self.__str__()
 
 
 class AccInfo(FetchableJsonObject):
@@ -882,7 +2502,10 @@ class Agents(PagedJsonObject):
         return "agent"
 
     def new_item(self, json_obj):
-        return Agent(self.accapi, json_obj)
+        return self.accapi.entity(Agent, json_obj)
+
+    def item_class(self):
+        return Agent
 
 
 class Agent(FetchableJsonObject):
@@ -891,9 +2514,7 @@ class Agent(FetchableJsonObject):
     Agent objects are created by Controller.agents()
     """
 
-    def __init__(self, accapi, json_obj_or_item_id):
-        super(Agent, self).__init__(accapi, json_obj_or_item_id)
-        self.update_id = None
+    supports_id_query = True
 
     def my_name(self):
         return "agent"
@@ -905,7 +2526,14 @@ class Agent(FetchableJsonObject):
                                                                                               filename,
                                                                                               destination,
                                                                                               operation))
-        return GenericJsonObject(self.accapi, json_obj)
+        if "id" not in json_obj:
+            # As with agentUpdateTask the id may only be in the hateous link
+            json_obj["id"] = os.path.basename(json_obj["_links"]["self"]["href"])
+
+        task = self.accapi.entity(AgentFileOperationTask, json_obj)
+        task.agent = self
+
+        return task
 
     def copy_file(self, filename, destination):
         return self.agent_file_operation_task(filename, destination, "COPY")
@@ -915,7 +2543,7 @@ class Agent(FetchableJsonObject):
         res, json_obj = self.accapi.http_post(
             "/apm/acc/diagnosticReportTask", '{"agent":"agent/%s"}' % self.item_id)
 
-        return DiagnosticReportTask(self.accapi, json_obj)
+        return self.accapi.entity(DiagnosticReportTask, json_obj)
 
     def set_log_level(self, value):
 
@@ -924,18 +2552,24 @@ class Agent(FetchableJsonObject):
             '{"agent":"agent/%s", "property":"log4j.logger.IntroscopeAgent", "value":"%s"}' % (self.item_id, value))
 
         # No update id easily accessible in the json unfortunately! Would need to parse the hateous link to get the end
-        self.update_id = os.path.basename(json_obj["_links"]["self"]["href"])
-        return GenericJsonObject(self.accapi, json_obj)
+        json_obj.setdefault("id", os.path.basename(json_obj["_links"]["self"]["href"]))
+
+        task = self.accapi.entity(AgentUpdateTask, json_obj)
+        task.agent = self
+
+        return task
 
-    def task_status(self):
+    def task_status(self, update_id=None):
         """
-        Get the task status of an agent
+        Get the status of an update task of the agent, update_id being the item_id of the
+        AgentUpdateTask returned by set_log_level
         """
-        if not self.update_id:
-            raise ACCException("Have no update id")
+        if update_id is None:
+            raise ACCException("task_status needs the item_id of the AgentUpdateTask returned by set_log_level, "
+                               "e.g. agent.task_status(agent.set_log_level(value).item_id)")
 
         return GenericJsonObject(self.accapi,
-                                 self.accapi.http_get_json("/apm/acc/agentUpdateTask", self.update_id))
+                                 self.accapi.http_get_json("/apm/acc/agentUpdateTask", update_id))
 
     def diagnostic_reports(self):
         """Return the diagnostic reports of the agent"""
@@ -947,10 +2581,11 @@ class Controllers(PagedJsonObject):
     def my_name(self):
         return "controller"
 
+    def item_class(self):
+        return Controller
+
     def new_item(self, json_obj):
-        c = Controller(self.accapi, json_obj["id"])
-        c.json = json_obj
-        return c
+        return self.accapi.entity(Controller, json_obj)
 
 
 class Controller(FetchableJsonObject):
@@ -959,6 +2594,8 @@ class Controller(FetchableJsonObject):
     See AccApi.controller
     """
 
+    supports_id_query = True
+
     def __init__(self, accapi, json_obj_or_item_id):
         super(Controller, self).__init__(accapi, json_obj_or_item_id)
         self.agentJson = None
@@ -973,7 +2610,7 @@ class Controller(FetchableJsonObject):
         res, json_obj = self.accapi.http_post(
             "/apm/acc/controllerUpgradeTask", '{"controller" : "controllers/%s"}' % self.item_id)
 
-        task = TaskStatus(self.accapi, json_obj)
+        task = self.accapi.entity(TaskStatus, json_obj)
         task.controller = self
 
         return task
@@ -986,9 +2623,7 @@ class Controller(FetchableJsonObject):
 
         try:
             for agent in self.agentJson["_embedded"]["agent"]:
-                x = Agent(self.accapi, agent["id"])
-                x.json = agent
-                yield x
+                yield self.accapi.entity(Agent, agent)
         except KeyError:
             # The controller might not have any agents
             pass
@@ -999,11 +2634,13 @@ class ControllerUpgradeStatus(PagedJsonObject):
         return "controllerUpgradeTask"
 
     def new_item(self, json_obj):
-        return TaskStatus(self.accapi, json_obj)
+        return self.accapi.entity(TaskStatus, json_obj)
 
 
 # Are all tasks the same? Upgrade task? diag report task?
 class TaskStatus(FetchableJsonObject):
+    supports_id_query = True
+
     def my_name(self):
         return "controllerUpgradeTask"
 
@@ -1013,26 +2650,25 @@ class DiagnosticReports(PagedJsonObject):
         return "diagnosticReport"
 
     def new_item(self, json_obj):
-        return DiagnosticReport(self.accapi, json_obj)
+        return self.accapi.entity(DiagnosticReport, json_obj)
 
 
 class DiagnosticReport(FetchableJsonObject):
+    supports_id_query = True
+
     def my_name(self):
         return "diagnosticReport"
 
     def filename(self):
         return "%s-%s-diagreport.zip" % (self["agentProperties"]["agentName"], self.item_id)
 
-    def download(self, filename=None):
+    def download(self, filename=None, progress=True):
 
         if not filename:
             filename = self.filename()
 
-        if not os.path.exists(filename):
-            res = self.accapi.http_get("/apm/acc/diagnosticReport", self.item_id, format="zip")
-            write_content_to_file(res, filename)
-
-        return filename
+        return self.accapi.download_to_file("/apm/acc/diagnosticReport", self.item_id, filename,
+                                            progress=progress, format="zip")
 
 
 class DiagnosticReportTasks(PagedJsonObject):
@@ -1040,10 +2676,12 @@ class DiagnosticReportTasks(PagedJsonObject):
         return "diagnosticReportTask"
 
     def new_item(self, json_obj):
-        return DiagnosticReportTask(self.accapi, json_obj)
+        return self.accapi.entity(DiagnosticReportTask, json_obj)
 
 
 class DiagnosticReportTask(FetchableJsonObject):
+    supports_id_query = True
+
     def my_name(self):
         return "diagnosticReportTask"
 
@@ -1052,12 +2690,40 @@ class DiagnosticReportTask(FetchableJsonObject):
         return self.accapi.diagnostic_report(self["diagReportId"])
 
 
+class AgentFileOperationTask(FetchableJsonObject):
+
+    """
+    See Agent.agent_file_operation_task
+    """
+
+    def __init__(self, accapi, json_obj_or_item_id):
+        super(AgentFileOperationTask, self).__init__(accapi, json_obj_or_item_id)
+        self.agent = None
+
+    def my_name(self):
+        return "agentFileOperationTask"
+
+
+class AgentUpdateTask(FetchableJsonObject):
+
+    """
+    See Agent.set_log_level
+    """
+
+    def __init__(self, accapi, json_obj_or_item_id):
+        super(AgentUpdateTask, self).__init__(accapi, json_obj_or_item_id)
+        self.agent = None
+
+    def my_name(self):
+        return "agentUpdateTask"
+
+
 class Files(PagedJsonObject):
     def my_name(self):
         return "file"
 
     def new_item(self, json_obj):
-        return FileMeta(self.accapi, json_obj)
+        return self.accapi.entity(FileMeta, json_obj)
 
 
 class FileMeta(FetchableJsonObject):
@@ -1065,8 +2731,25 @@ class FileMeta(FetchableJsonObject):
     def my_name(self):
         return "file"
 
-    def download_file(self):
-        return self.accapi.download_file(self["id"])
+    def filename(self):
+        return "acc_%s_%s" % (self["id"], self["name"])
+
+    def download_file(self, filename=None, fileobj=None, progress=False):
+        """See AccApi.download_file, checking the size downloaded against the meta data"""
+        return self.accapi.download_file(self["id"], filename, fileobj, size=self["size"], progress=progress)
+
+    def iter_content(self, chunk_size=FILE_CHUNK_SIZE):
+        return self.accapi.iter_file(self["id"], chunk_size, size=self["size"])
+
+    def download(self, directory=None, filename=None, progress=True):
+
+        if not filename:
+            filename = self.filename()
+
+        if directory:
+            filename = os.path.join(directory, filename)
+
+        return self.download_file(filename, progress=progress)
 
 
 class AuditRecords(PagedJsonObject):
@@ -1074,7 +2757,7 @@ class AuditRecords(PagedJsonObject):
         return "auditRecord"
 
     def new_item(self, json_obj):
-        return AuditRecord(self.accapi, json_obj)
+        return self.accapi.entity(AuditRecord, json_obj)
 
 
 class AuditRecord(FetchableJsonObject):
@@ -1096,7 +2779,7 @@ class SecurityTokens(PagedJsonObject):
         # e.g. "https://accdemowin05.ca.com:8443/apm/acc/private/securityToken/18/principal"
         json_obj["id"] = json_obj["_links"]["principal"]["href"].split("/")[-2]
 
-        return SecurityToken(self.accapi, json_obj)
+        return self.accapi.entity(SecurityToken, json_obj)
 
 
 class SecurityToken(FetchableJsonObject):
@@ -1117,7 +2800,7 @@ class Bundles(PagedJsonObject):
         return "bundle"
 
     def new_item(self, json_obj):
-        return Bundle(self.accapi, json_obj)
+        return self.accapi.entity(Bundle, json_obj)
 
 
 class Bundle(FetchableJsonObject):
@@ -1130,12 +2813,16 @@ class Bundle(FetchableJsonObject):
         return "bundle"
 
     def profile(self):
-        return Profile(self.accapi, self.item_id)
+        return self.accapi.entity(Profile, self.item_id)
 
     def filename(self):
         return "%s-%s.tar.gz" % (self["name"], self["version"])
 
-    def download(self, directory=None, filename=None):
+    def cache_key(self):
+        """What identifies the content of this bundle in the BundleCache"""
+        return "%s:%s:%s" % (self.item_id, self["version"], self.get_json().get("checksum") or "")
+
+    def download(self, directory=None, filename=None, progress=True):
 
         if not filename:
             filename = self.filename()
@@ -1143,9 +2830,21 @@ class Bundle(FetchableJsonObject):
         if directory:
             filename = os.path.join(directory, filename)
 
-        if not os.path.exists(filename):
-            res = self.accapi.http_get("/apm/acc/bundle", self.item_id, format="tar.gz")
-            write_content_to_file(res, filename)
+        if os.path.exists(filename):
+            print("Skipping writing existing:", filename)
+            return filename
+
+        cache = self.accapi.bundle_cache
+
+        if cache and cache.get(self.cache_key(), filename):
+            debug("bundle %s from cache" % filename)
+            return filename
+
+        self.accapi.download_to_file("/apm/acc/bundle", self.item_id, filename,
+                                     progress=progress, format="tar.gz")
+
+        if cache:
+            cache.put(self.cache_key(), filename)
 
         return filename
 
@@ -1171,44 +2870,49 @@ class Packages(PagedJsonObject):
         return "package"
 
     def new_item(self, json_obj):
-        return Package(self.accapi, json_obj)
+        return self.accapi.entity(Package, json_obj)
 
 
 class Package(FetchableJsonObject):
+    supports_id_query = True
+
     def my_name(self):
         return "package"
 
-    def download(self, base_dir=".", archive_format="archive", filename=None):
+    def download(self, base_dir=".", archive_format="archive", filename=None, progress=True):
 
         print("Start initial download request")
 
         # Pass a custom header
         headers = self.accapi.headers.copy()
         headers["accept"] = "application/x-tar"
-        res = self.accapi.http_get("/apm/acc/package", self.item_id, headers, format=archive_format)
 
-        if not filename:
-            filename = get_filename_from_content_disp(res)
+        if filename:
+            # Knowing the filename up front means an interrupted download can be resumed
+            return self.accapi.download_to_file("/apm/acc/package", self.item_id, os.path.join(base_dir, filename),
+                                                headers, progress=progress, format=archive_format)
+
+        res = self.accapi.http_get("/apm/acc/package", self.item_id, headers, format=archive_format)
 
-        filename = os.path.join(base_dir, filename)
-        write_content_to_file(res, filename)
+        filename = os.path.join(base_dir, get_filename_from_content_disp(res))
+        write_content_to_file(res, filename, progress=progress)
 
         return filename
 
     def required_bundles(self):
         bundles = self.accapi.http_get_json("/apm/acc/package", "%s/%s" % (self.item_id, "requiredBundles"))
         for bundle in bundles["_embedded"]["bundle"]:
-            yield(Bundle(self.accapi, bundle))
+            yield(self.accapi.entity(Bundle, bundle))
 
     def compatible_bundles(self):
         bundles = self.accapi.http_get_json("/apm/acc/package", "%s/%s" % (self.item_id, "compatibleBundles"))
         for bundle in bundles["_embedded"]["bundle"]:
-            yield(Bundle(self.accapi, bundle))
+            yield(self.accapi.entity(Bundle, bundle))
 
     def bundles(self):
         bundles = self.accapi.http_get_json("/apm/acc/package", "%s/%s" % (self.item_id, "bundles"))
         for bundle in bundles["_embedded"]["bundle"]:
-            yield(Bundle(self.accapi, bundle))
+            yield(self.accapi.entity(Bundle, bundle))
 
     def add_bundles(self, bundles, draft="false"):
         """{"bundles":["bundle/1","bundle/2"],"draft":false}"""
@@ -1232,6 +2936,677 @@ class Package(FetchableJsonObject):
         res, json_obj = self.accapi.http_patch("/apm/acc/package/" + str(self.item_id), body)
 
 
+class PackageBuilder(object):
+
+    """
+    Accumulates the environment, bundles and overrides of a new package locally and then
+    creates it in the fewest requests.
+
+    If everything is known up front build() creates the complete package with a single POST.
+    When the compatible or required bundles are needed to decide what goes in the package,
+    call draft() first to create a draft package to query, and build() then completes it
+    with a single PATCH.
+    """
+
+    def __init__(self, accapi, name, os, appserver, em_host, agent_version, process_display_name, comment):
+        self.accapi = accapi
+        self.name = name
+        self.environment = {"osName": os,
+                            "process": appserver,
+                            "agentVersion": agent_version,
+                            "processDisplayName": process_display_name}
+        self.em_host = em_host
+        self.comment = comment
+        self.bundle_ids = []
+        self.overrides = {}
+        self.package = None
+
+    def add_bundles(self, bundle_ids):
+        for bundle_id in bundle_ids:
+            if bundle_id not in self.bundle_ids:
+                self.bundle_ids.append(bundle_id)
+
+    def add_override(self, bundle_name, name, value, user_key=None, description=None, hidden=False):
+        """
+        Override property name in the named bundle.
+        user_key should be "+" for properties which the bundle doesn't already have.
+        """
+        overrides = self.overrides.setdefault(bundle_name, {"preamble": None, "properties": []})
+
+        overrides["properties"].append({"description": description,
+                                        "hidden": hidden,
+                                        "name": name,
+                                        "value": value,
+                                        "userKey": user_key})
+
+    def add_overrides(self, overrides):
+        """Add overrides already in json structure, i.e. bundle name -> {"preamble": ..., "properties": [...]}"""
+        for bundle_name, bundle_overrides in overrides.iteritems():
+            exist = self.overrides.setdefault(bundle_name, {"preamble": None, "properties": []})
+            if bundle_overrides.get("preamble"):
+                exist["preamble"] = bundle_overrides["preamble"]
+            exist["properties"].extend(bundle_overrides.get("properties") or [])
+
+    def body(self, draft):
+        body = {"draft": draft,
+                "environment": self.environment,
+                "bundleOverrides": self.overrides,
+                "emHost": self.em_host,
+                "packageName": self.name,
+                "comment": self.comment}
+
+        if self.bundle_ids:
+            body["bundles"] = ["bundle/%s" % bundle_id for bundle_id in self.bundle_ids]
+
+        return body
+
+    def draft(self):
+        """Create a draft package, so its compatible and required bundles can be looked at. Returns the Package"""
+        res, package_json = self.accapi.http_post("/apm/acc/package", json.dumps(self.body(True)))
+
+        self.package = self.accapi.package(package_json)
+
+        # Start from whatever overrides the server put in the new package
+        overrides, self.overrides = self.overrides, {}
+        self.add_overrides(self.package["bundleOverrides"] or {})
+        self.add_overrides(overrides)
+
+        return self.package
+
+    def build(self):
+        """Create the package, or complete the draft package, and return it"""
+        if not self.package:
+            res, package_json = self.accapi.http_post("/apm/acc/package", json.dumps(self.body(False)))
+            self.package = self.accapi.package(package_json)
+        else:
+            body = {"draft": False, "bundleOverrides": self.overrides}
+
+            if self.bundle_ids:
+                body["bundles"] = ["bundle/%s" % bundle_id for bundle_id in self.bundle_ids]
+
+            res, package_json = self.accapi.http_patch("/apm/acc/package/" + str(self.package.item_id), json.dumps(body))
+
+            if package_json:
+                self.package.json = package_json
+
+        return self.package
+
+
+class InventoryMirror(object):
+
+    """
+    A local SQLite copy of the agent, controller and package inventory, so that list
+    and filter queries can be answered without going to the Config Server (see AccApi.mirror).
+
+    sync() brings a collection up to date.  Where the collection has a timestamp, an
+    incremental sync requests the newest items first and stops at the first item older
+    than the previous sync.  That picks up new items but not changes to, or removal of,
+    existing ones, so a full sync (the default for collections without a timestamp)
+    should still be run periodically.
+    """
+
+    # collection name -> timestamp field used for incremental syncs (None means always full)
+    timestamp_fields = {
+        "agent": "registrationTimestamp",
+        "controller": None,
+        "package": "modified",
+    }
+
+    # indexed column -> path to the value in the json.  These are the fields which can be filtered on.
+    columns = collections.OrderedDict([
+        ("agentName", ("agentName",)),
+        ("serverName", ("serverName",)),
+        ("appServerName", ("appServerName",)),
+        ("packageDetailsId", ("packageDetails", "id")),
+        ("status", ("status",)),
+    ])
+
+    query_re = re.compile(r"\s+(AND|OR)\s+")
+    term_re = re.compile(r"^(-?)([\w.]+):(.+)$")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS sync_state "
+                            "(collection TEXT PRIMARY KEY, watermark TEXT, last_sync REAL, last_full_sync REAL)")
+
+            for name in self.timestamp_fields:
+                self.db.execute("CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, %s, timestamp TEXT, json TEXT NOT NULL)" % (
+                    name, ", ".join(["%s TEXT" % column for column in self.columns])))
+
+                for column in self.columns.keys() + ["timestamp"]:
+                    self.db.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s COLLATE NOCASE)" % (
+                        name, column, name, column))
+
+    def close(self):
+        self.db.close()
+
+    def _row(self, name, json_obj):
+        row = [str(json_obj["id"])]
+
+        for path in self.columns.values():
+            value = json_obj
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+
+            row.append(None if value is None else unicode(value))
+
+        timestamp_field = self.timestamp_fields[name]
+        row.append(json_obj.get(timestamp_field) if timestamp_field else None)
+        row.append(json.dumps(json_obj))
+
+        return row
+
+    def state(self, name):
+        """Return (watermark, last_sync, last_full_sync) for the collection"""
+        row = self.db.execute("SELECT watermark, last_sync, last_full_sync FROM sync_state WHERE collection = ?",
+                              (name,)).fetchone()
+        return row or (None, None, None)
+
+    def sync(self, accapi, name, full=False):
+        """
+        Bring the mirror of the named collection up to date from the server.
+        Returns the number of items fetched.
+        """
+        timestamp_field = self.timestamp_fields[name]
+        watermark, last_sync, last_full_sync = self.state(name)
+
+        full = full or not timestamp_field or not last_full_sync
+
+        collection_class = {"agent": Agents, "controller": Controllers, "package": Packages}[name]
+
+        if full:
+            items = collection_class(accapi, None)
+        else:
+            items = collection_class(accapi, None, sort="%s,desc" % timestamp_field)
+
+        insert = "INSERT OR REPLACE INTO %s VALUES (%s)" % (name, ", ".join(["?"] * (len(self.columns) + 3)))
+        started = time.time()
+        count = 0
+        new_watermark = watermark
+
+        with self.db:
+            if full:
+                self.db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY)")
+                self.db.execute("DELETE FROM seen")
+
+            for item in items:
+                row = self._row(name, item.json)
+                timestamp = row[-2]
+
+                if not full and watermark and timestamp and timestamp < watermark:
+                    # Everything from here on is older than the last sync
+                    break
+
+                self.db.execute(insert, row)
+                count += 1
+
+                if full:
+                    self.db.execute("INSERT OR IGNORE INTO seen VALUES (?)", (row[0],))
+
+                if timestamp and (new_watermark is None or timestamp > new_watermark):
+                    new_watermark = timestamp
+
+            if full:
+                # Remove anything no longer on the server
+                self.db.execute("DELETE FROM %s WHERE id NOT IN (SELECT id FROM seen)" % name)
+                last_full_sync = started
+
+            self.db.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)",
+                            (name, new_watermark, started, last_full_sync))
+
+        debug("synced %d %s items in %.2fs (full=%s)" % (count, name, time.time() - started, full))
+
+        return count
+
+    def _where(self, name, q):
+        """Translate a simple query such as "appServerName:Tomcat OR appServerName:JBoss" to SQL"""
+        if not q:
+            return "", []
+
+        sql = []
+        params = []
+
+        for i, part in enumerate(self.query_re.split(q.strip())):
+            if i % 2:
+                sql.append(part)
+                continue
+
+            match = self.term_re.match(part)
+            if not match:
+                raise ACCMirrorQueryException("unsupported query term '%s'" % part)
+
+            negate, field, value = match.groups()
+            column = self._column(name, field)
+
+            value = value.strip('"')
+            if "(" in value or ")" in value:
+                raise ACCMirrorQueryException("unsupported query term '%s'" % part)
+
+            if "*" in value:
+                condition = "%s LIKE ? ESCAPE '\\'" % column
+                params.append(self._like_pattern(value))
+            else:
+                condition = "%s = ? COLLATE NOCASE" % column
+                params.append(value)
+
+            if negate:
+                # Like the server, a negated term matches items without the field
+                condition = "(%s IS NULL OR NOT %s)" % (column, condition)
+
+            sql.append(condition)
+
+        return "WHERE " + " ".join(sql), params
+
+    # noinspection PyMethodMayBeStatic
+    def _like_pattern(self, value):
+        """LIKE pattern for a value with * wildcards, matching any other characters literally"""
+        for char in ("\\", "%", "_"):
+            value = value.replace(char, "\\" + char)
+        return value.replace("*", "%")
+
+    def _column(self, name, field):
+        if field == "id":
+            return "id"
+
+        if field == self.timestamp_fields[name]:
+            return "timestamp"
+
+        for column, path in self.columns.iteritems():
+            if field == ".".join(path):
+                return column
+
+        raise ACCMirrorQueryException("field '%s' is not in the mirror" % field)
+
+    def query(self, name, q=None, sort=None, page=None, size=None):
+        """
+        Return an iterator over the json of the items in the named collection matching the same q, sort,
+        page and size parameters as the REST API accepts, or raise ACCMirrorQueryException
+        if the mirror can not answer the query.
+        """
+        if name not in self.timestamp_fields or self.state(name)[1] is None:
+            raise ACCMirrorQueryException("collection '%s' has not been synced" % name)
+
+        where, params = self._where(name, q)
+
+        order = ""
+        if sort:
+            field, _, direction = sort.partition(",")
+            order = "ORDER BY %s COLLATE NOCASE %s" % (self._column(name, field),
+                                                        "DESC" if direction.lower() == "desc" else "ASC")
+
+        limit = ""
+        if page is not None:
+            limit = "LIMIT %d OFFSET %d" % (int(size), int(size) * int(page))
+
+        return self._query_json("SELECT json FROM %s %s %s %s" % (name, where, order, limit), params)
+
+    def _query_json(self, sql, params):
+        for (json_text,) in self.db.execute(sql, params):
+            yield json.loads(json_text)
+
+    def get(self, name, item_id):
+        row = self.db.execute("SELECT json FROM %s WHERE id = ?" % name, (str(item_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+class BundleCache(object):
+
+    """
+    A size bounded, content addressed store of downloaded bundles shared by all scripts.
+
+    Files are stored once per distinct content (by sha256) under directory/objects, and
+    index.json maps bundle keys (id, version and checksum, see Bundle.cache_key) to them.
+    When the store grows beyond max_bytes the least recently used files are removed.
+    Changes are made holding an exclusive lock on directory/lock (where the platform has
+    fcntl), re-reading the index and replacing it atomically, so several processes can
+    share the cache.
+    """
+
+    def __init__(self, directory, max_bytes=BUNDLE_CACHE_SIZE * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_filename = os.path.join(directory, "index.json")
+        self.lock = threading.Lock()
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the cache lock, against both other threads and other processes"""
+        with self.lock:
+            with open(os.path.join(self.directory, "lock"), "a") as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, key, filename):
+        """Write the cached content for key to filename, returning False if it is not cached"""
+        if not os.path.exists(self.index_filename):
+            return False
+
+        tmp_filename = partial_filename(filename)
+
+        with self.locked():
+            index = read_json_file(self.index_filename)
+            entry = index.get(key)
+
+            if not entry or not os.path.exists(self.object_path(entry["sha256"])):
+                return False
+
+            # A copy, so that nothing done to filename can change the cached content
+            shutil.copyfile(self.object_path(entry["sha256"]), tmp_filename)
+
+            entry["used"] = time.time()
+            write_json_file(self.index_filename, index)
+
+        os.rename(tmp_filename, filename)
+
+        return True
+
+    def put(self, key, filename):
+        """Add the content of filename to the cache as key"""
+        sha256 = hashlib.sha256()
+        with open(filename, "rb") as fin:
+            for block in iter(lambda: fin.read(1048576), b""):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+
+        object_path = self.object_path(digest)
+
+        if not os.path.exists(os.path.dirname(object_path)):
+            try:
+                os.makedirs(os.path.dirname(object_path), 0o700)
+            except OSError as e:
+                # Another process may have just created it
+                if e.errno != errno.EEXIST:
+                    raise
+
+        with self.locked():
+            if not os.path.exists(object_path):
+                tmp_filename = partial_filename(object_path)
+                shutil.copyfile(filename, tmp_filename)
+                os.rename(tmp_filename, object_path)
+
+            index = read_json_file(self.index_filename)
+            index[key] = {"sha256": digest, "size": os.path.getsize(object_path), "used": time.time()}
+            self.evict(index)
+            write_json_file(self.index_filename, index)
+
+    def evict(self, index):
+        """
+        Remove the least recently used files until the cache is within max_bytes.
+        Every file under objects counts, including any the index has lost track of,
+        which are used as of when they were written.
+        """
+        used = {}
+        for key, entry in index.iteritems():
+            used[entry["sha256"]] = max(used.get(entry["sha256"], 0), entry["used"])
+
+        objects = {}
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.directory, "objects")):
+            for digest in filenames:
+                if digest.endswith(".part"):
+                    continue
+
+                path = os.path.join(dirpath, digest)
+                try:
+                    objects[digest] = (os.path.getsize(path), used.get(digest, os.path.getmtime(path)))
+                except OSError:
+                    pass
+
+        total = sum(size for size, last_used in objects.itervalues())
+
+        for digest, (size, last_used) in sorted(objects.iteritems(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+
+            debug("evicting %s from bundle cache" % digest)
+            try:
+                os.remove(self.object_path(digest))
+            except OSError:
+                pass
+            total -= size
+
+            for key in [key for key, entry in index.iteritems() if entry["sha256"] == digest]:
+                del index[key]
+
+
+class BundleIndex(object):
+
+    """
+    An inverted index of the files and properties provided by bundles, as used to map
+    agent installations and profiles to packages.
+
+    Names are interned and each bundle's versions are parsed and sorted once, so finding
+    the bundles (or the compatible bundles) that provide a file or property is a
+    dictionary lookup and choosing the highest version of a bundle doesn't compare
+    versions again.
+    """
+
+    kinds = ["file", "property"]
+
+    def __init__(self):
+        self.strings = {}
+        self.parsed_versions = {}  # version -> LooseVersion
+        self.versions = {}  # bundle name -> version -> Bundle
+        self.sorted_versions = {}  # bundle name -> [(LooseVersion, version)], lowest first
+        self.providers = dict((kind, {}) for kind in BundleIndex.kinds)  # kind -> key -> bundle name -> version -> Bundle
+        self.values = {}  # (bundle name, version) -> property name -> value
+
+    def intern(self, s):
+        return self.strings.setdefault(s, s)
+
+    def version_key(self, version):
+        """Return the parsed, comparable, form of a version string"""
+        key = self.parsed_versions.get(version)
+        if key is None:
+            key = self.parsed_versions[version] = LooseVersion(version)
+        return key
+
+    def add_bundle(self, bundle):
+        """Register a bundle's version. Returns the interned (name, version)"""
+        name = self.intern(bundle["name"])
+        version = self.intern(bundle["version"])
+
+        versions = self.versions.setdefault(name, {})
+        if version not in versions:
+            versions[version] = bundle
+            bisect.insort(self.sorted_versions.setdefault(name, []), (self.version_key(version), version))
+
+        return name, version
+
+    def add(self, kind, bundle, keys):
+        """Record that bundle provides each of keys, the names of files or properties"""
+        name, version = self.add_bundle(bundle)
+        providers = self.providers[kind]
+
+        for key in keys:
+            providers.setdefault(self.intern(key), {}).setdefault(name, {}).setdefault(version, bundle)
+
+    def add_files(self, bundle, filenames):
+        self.add("file", bundle, filenames)
+
+    def add_properties(self, bundle, properties):
+        """properties is a dictionary of property name -> value from the bundle's profile"""
+        name, version = self.add_bundle(bundle)
+        self.values[(name, version)] = dict((self.intern(prop), value) for prop, value in properties.iteritems())
+        self.add("property", bundle, properties)
+
+    def has_properties(self, bundle):
+        return (bundle["name"], bundle["version"]) in self.values
+
+    def value(self, bundle, prop):
+        """The value of prop in the bundle's profile, or None"""
+        return self.values.get((bundle["name"], bundle["version"]), {}).get(prop)
+
+    def lookup(self, kind, key):
+        """Return bundle name -> version -> Bundle for the bundles providing the file or property key"""
+        return self.providers[kind].get(key, {})
+
+    def bundles(self, kind, key):
+        """Return a list of the bundles, of any version, providing the file or property key"""
+        return [bundle for versions in self.lookup(kind, key).itervalues() for bundle in versions.itervalues()]
+
+    def compatible(self, kind, key, compatible_bundles):
+        """
+        Return a list of the bundles providing the file or property key at the versions
+        given by compatible_bundles, a dictionary of bundle name -> Bundle
+        """
+        result = []
+        for name, versions in self.lookup(kind, key).iteritems():
+            compat = compatible_bundles.get(name)
+            if compat:
+                bundle = versions.get(compat["version"])
+                if bundle:
+                    result.append(bundle)
+        return result
+
+    def highest(self, name, versions=None):
+        """
+        Return the highest version of the named bundle, choosing from versions (a dictionary
+        of version -> Bundle) if given, otherwise from all the versions in the index.
+        """
+        if versions is None:
+            versions = self.versions.get(name, {})
+
+        for key, version in reversed(self.sorted_versions.get(name, [])):
+            bundle = versions.get(version)
+            if bundle:
+                return bundle
+
+        return None
+
+    def latest(self, bundles):
+        """Return a dictionary of bundle name -> the highest version of that bundle in bundles"""
+        by_name = {}
+        for bundle in bundles:
+            name, version = self.add_bundle(bundle)
+            by_name.setdefault(name, {})[version] = bundle
+
+        return dict((name, self.highest(name, versions)) for name, versions in by_name.iteritems())
+
+
+class MirroredCollection(object):
+
+    """
+    Stands in for a PagedJsonObject (Agents, Controllers...) but is answered from an InventoryMirror.
+    Raises ACCMirrorQueryException if the request parameters can not be handled by the mirror.
+    """
+
+    def __init__(self, accapi, mirror, name, cls, q=None, sort=None, page=None, size=None, compact=None, fields=None,
+                 **kwargs):
+        if kwargs:
+            raise ACCMirrorQueryException("unsupported parameters %s" % kwargs.keys())
+
+        self.accapi = accapi
+        self.mirror = mirror
+        self.name = name
+        self.cls = cls
+        self.layout = CompactLayout(accapi, cls, compact) if compact else None
+        self.fields = frozenset(fields or ())
+        self.query_args = dict(q=q, sort=sort, page=page, size=size or accapi.page_size)
+
+        # Check up front that the query can be answered
+        self.mirror.query(name, **self.query_args)
+
+    def __iter__(self):
+        for json_obj in self.mirror.query(self.name, **self.query_args):
+            if self.layout:
+                yield CompactRecord(self.layout, json_obj)
+            elif self.fields:
+                json_obj = project(json_obj, self.fields)
+                item = self.accapi.entity(self.cls, json_obj)
+                if item.json is json_obj:
+                    item.partial = True
+                yield item
+            else:
+                yield self.accapi.entity(self.cls, json_obj)
+
+    def __getitem__(self, key):
+        json_obj = self.mirror.get(self.name, key)
+        return self.accapi.entity(self.cls, json_obj if json_obj else str(key))
+
+
+class PackageBatchMixin(object):
+
+    """
+    Batch runs for the scripts which create packages, e.g. agent2package.py and profile2package.py.
+    Mix in ahead of AccCommandLineApp:
+
+        class App(pyacc.PackageBatchMixin, pyacc.AccCommandLineApp):
+    """
+
+    def batch_inputs(self, path, extensions, **defaults):
+        """
+        Read the inputs for a batch run, returning a list of dictionaries each with a "file" key
+        plus the keys of defaults.
+
+        path is either a directory, where every file ending in one of extensions is an input, or a
+        CSV manifest with a "file" column and optionally columns named after any of the defaults
+        (e.g. os, appserver, agent_version) to override them for that file.
+        Files in a manifest are relative to the manifest.
+        """
+        if os.path.isdir(path):
+            return [dict(defaults, file=os.path.join(path, name))
+                    for name in sorted(os.listdir(path)) if name.endswith(tuple(extensions))]
+
+        inputs = []
+        with open(path, "rb") as fin:
+            for row in csv.DictReader(fin):
+                if not row.get("file"):
+                    raise ACCConfigurationException("%s: each line of a batch manifest needs a file" % path)
+
+                entry = dict(defaults)
+                entry.update((key, value) for key, value in row.iteritems() if key in defaults and value)
+                entry["file"] = os.path.join(os.path.dirname(path), row["file"])
+                inputs.append(entry)
+
+        return inputs
+
+    # noinspection PyMethodMayBeStatic
+    def write_batch_summary(self, filename, fields, rows):
+        """Write a CSV file with a line for each of rows (dictionaries keyed by fields)"""
+        with open(filename, "wb") as fout:
+            writer = csv.DictWriter(fout, fields, extrasaction="ignore")
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(dict((key, safe(value) if value is not None else "") for key, value in row.iteritems()))
+
+        print("Wrote summary to %s" % filename)
+
+    def write_batch_results(self, filename, results):
+        """
+        Wait for the packages of a batch and write the summary of them (see write_batch_summary).
+        results are (input, future of (package, filename), error) for each input from batch_inputs,
+        where error is set instead of the future if the package could not be planned.
+        """
+        rows = []
+        for entry, future, error in results:
+            row = dict(entry)
+            try:
+                if error:
+                    raise error
+                new_package, package_filename = future.get()
+                print("Created package %s for %s" % (new_package["id"], entry["file"]))
+                row.update(package_id=new_package["id"], filename=package_filename)
+            except Exception as e:
+                print("ERROR: could not create a package for %s: %s" % (entry["file"], e))
+                row["error"] = e
+            rows.append(row)
+
+        self.write_batch_summary(filename,
+                                 ["file", "name", "os", "appserver", "agent_version", "package_id", "filename", "error"],
+                                 rows)
+
+
 class AccCommandLineApp(object):
 
     """
@@ -1244,7 +3619,7 @@ class AccCommandLineApp(object):
     """
 
     def __init__(self):
-        self.acc = self.parser = self.args = self.acc_env = None
+        self.acc = self.async_acc = self.parser = self.args = self.acc_env = None
         self.parser = argparse.ArgumentParser(description=self.description())
 
         self.parser_group = self.parser.add_argument_group("pyacc standard options")
@@ -1275,6 +3650,43 @@ class AccCommandLineApp(object):
         self.parser_group.add_argument(
             '--page-size', dest='page_size', action='store', default=PAGE_SIZE, type=int, help='page size for multi-page requests')
 
+        self.parser_group.add_argument(
+            '--pool-size', dest='pool_size', action='store', default=POOL_SIZE, type=int,
+            help='number of idle keep-alive connections to keep open to the server (0 disables reuse)')
+
+        self.parser_group.add_argument(
+            '--pool-idle-timeout', dest='pool_idle_timeout', action='store', default=POOL_IDLE_TIMEOUT, type=float,
+            help='seconds after which an idle keep-alive connection is not reused')
+
+        self.parser_group.add_argument(
+            '--page-workers', dest='page_workers', action='store', default=PAGE_WORKERS, type=int,
+            help='number of pages of multi-page requests to fetch concurrently (1 fetches a page at a time)')
+
+        self.parser_group.add_argument(
+            '--concurrency', dest='concurrency', action='store', default=CONCURRENCY, type=int,
+            help='maximum number of requests in flight for bulk operations')
+
+        self.parser_group.add_argument(
+            '--bundle-cache-size', dest='bundle_cache_size', action='store', default=BUNDLE_CACHE_SIZE, type=int,
+            help='MB of downloaded bundles to keep in ~/.acc/cache for reuse (0 disables the cache)')
+
+        self.parser_group.add_argument(
+            '--response-cache', dest='response_cache', action='store', default="memory", choices=["off", "memory", "disk"],
+            help='keep json responses to make conditional (ETag/Last-Modified) requests for them again, '
+                 'in memory or in ~/.acc/cache (default memory)')
+
+        self.parser_group.add_argument(
+            '--response-cache-size', dest='response_cache_size', action='store', default=RESPONSE_CACHE_SIZE, type=int,
+            help='MB of json responses to keep in the response cache')
+
+        self.parser_group.add_argument(
+            '--response-cache-ttl', dest='response_cache_ttl', action='store', default=RESPONSE_CACHE_TTL, type=float,
+            help='seconds a json response is kept in the response cache')
+
+        self.parser_group.add_argument(
+            '--offline', action='store_true',
+            help='answer agent/controller/package list queries from the local inventory mirror (see sync.py)')
+
     def run(self):
         self.build_arg_parser()
         self.args = self.parser.parse_args()
@@ -1295,8 +3707,38 @@ class AccCommandLineApp(object):
 
         token = self.acc_env.get_can_be_empty("token")
 
-        self.acc = AccApi(server, token, self.args.page_size)
-        self.main()
+        response_cache = None
+        if self.args.response_cache == "memory":
+            response_cache = MemoryResponseCache(self.args.response_cache_size * 1024 * 1024,
+                                                 self.args.response_cache_ttl)
+        elif self.args.response_cache == "disk":
+            response_cache = DiskResponseCache(self.acc_env.cache_path("%s-responses" % self.acc_env.profile),
+                                               self.args.response_cache_size * 1024 * 1024,
+                                               self.args.response_cache_ttl)
+
+        self.acc = AccApi(server, token, self.args.page_size,
+                          pool_size=self.args.pool_size,
+                          pool_idle_timeout=self.args.pool_idle_timeout,
+                          page_workers=self.args.page_workers,
+                          response_cache=response_cache)
+
+        if self.args.offline:
+            self.acc.mirror = InventoryMirror(self.acc_env.mirror_path())
+
+        if self.args.bundle_cache_size > 0:
+            self.acc.bundle_cache = BundleCache(self.acc_env.cache_path("bundles"),
+                                                self.args.bundle_cache_size * 1024 * 1024)
+
+        # Worker threads are only started if it is used
+        self.async_acc = AsyncAccApi(self.acc, self.args.concurrency)
+
+        try:
+            self.main()
+        finally:
+            self.async_acc.close()
+            self.acc.close()
+            if self.acc.mirror:
+                self.acc.mirror.close()
 
         # This code is to suppress "close failed in file object destructor" error and
         # IOError: [Errno 32] Broken pipe
@@ -1310,6 +3752,7 @@ class AccCommandLineApp(object):
                 # Something other than broken pipe, so re-raise
                 raise
 
+    # noinspection PyMethodMayBeStatic
     def main(self):
         """
         Override this for your command line tool.
@@ -1345,8 +3788,9 @@ class Examples(AccCommandLineApp):
                 raise
         else:
             print("Copy that file to the agents")
-            for agent in acc.agents():
-                agent.copy_file(x["id"], "this_is_a_copied_file")
+            push = acc.file_push(x["id"], "this_is_a_copied_file")
+            for result in push.submit(acc.agents()):
+                print(result)
 
         print("All Diagnostic Report Tasks")
         for diagnostic_report_task in acc.diagnostic_report_tasks():
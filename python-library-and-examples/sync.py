@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import time
+
+import pyacc
+
+
+class App(pyacc.AccCommandLineApp):
+    """
+    Mirror the agent, controller and package inventory into a local SQLite database
+    (in ~/.acc/cache) so that other scripts run with --offline can answer list queries
+    without fetching everything from the Config Server.
+
+    Agents and packages are synced incrementally (new items only) once they have had an
+    initial full sync; use --full periodically to pick up changes and removals.
+    """
+
+    collections = ["agent", "controller", "package"]
+
+    def build_arg_parser(self):
+        """
+        Add some more args to the standard set
+        """
+        super(App, self).build_arg_parser()
+
+        self.parser.add_argument('--full', action='store_true', help="re-fetch everything rather than only new items")
+
+        self.parser.add_argument('collections', metavar='COLLECTION', nargs='*', type=str,
+                                 help='collections to sync (default all of: %s)' % ", ".join(App.collections))
+
+    def main(self):
+
+        mirror = pyacc.InventoryMirror(self.acc_env.mirror_path())
+        print("Inventory mirror is", mirror.filename)
+
+        for name in self.args.collections or App.collections:
+            if name not in App.collections:
+                print("Unknown collection '%s', expected one of: %s" % (name, ", ".join(App.collections)))
+                continue
+
+            start = time.time()
+            count = mirror.sync(self.acc, name, full=self.args.full)
+            print("%s\t%d fetched in %.1fs" % (name, count, time.time() - start))
+
+        mirror.close()
+
+
+if __name__ == "__main__":
+    App().run()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Tests for pyacc against a local stand-in for the Config Server.
+
+    python -m unittest test_pyacc
+"""
+
+from __future__ import print_function
+
+import json
+import threading
+import time
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+import pyacc
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Answers every request with {"id": n} (201 Created for a POST), closing connections left idle for over a second"""
+
+    protocol_version = "HTTP/1.1"
+    timeout = 1
+
+    def respond(self):
+        length = int(self.headers.get("content-length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        self.server.requests.append(self.command)
+
+        body = json.dumps({"id": len(self.server.requests)})
+        self.send_response(201 if self.command == "POST" else 200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PATCH = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(("127.0.0.1", 0), KeepAliveHandler)
+        self.server.requests = []
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.acc = pyacc.AccRaw("http://127.0.0.1:%d" % self.server.server_port, "token")
+
+    def tearDown(self):
+        self.acc.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_post_after_server_closes_idle_connection(self):
+        self.acc.http_get_json("/apm/acc/agent", None)
+
+        # Longer than the server's keep-alive timeout, shorter than ours
+        time.sleep(2)
+
+        res, json_obj = self.acc.http_post("/apm/acc/agentUpdateTask", "{}")
+
+        self.assertEqual(json_obj, {"id": 2})
+        self.assertEqual(self.server.requests, ["GET", "POST"])
+
+    def test_idle_connection_is_reused(self):
+        self.acc.http_get_json("/apm/acc/agent", None)
+        pool = self.acc._get_pool()
+        conn = pool.idle[-1][0]
+
+        self.acc.http_post("/apm/acc/agentUpdateTask", "{}")
+
+        self.assertIs(pool.idle[-1][0], conn)
+
+
+if __name__ == "__main__":
+    unittest.main()
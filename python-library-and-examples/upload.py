@@ -2,12 +2,15 @@
 
 from __future__ import print_function
 
+import sys
+
 import pyacc
 
-# TODO  and optionally push to agents?
+
 class App(pyacc.AccCommandLineApp):
     """
-    Upload files to config server. Note that the file upload option needs to be enabled on the Config Server
+    Upload files to config server, and optionally push them to agents. Note that the file upload option
+    needs to be enabled on the Config Server
     (agent.file.management.enabled=true in APMCommandCenterServer/config/apmccsrv.properties)
     """
     def build_arg_parser(self):
@@ -15,16 +18,82 @@ class App(pyacc.AccCommandLineApp):
         Add some more args to the standard set
         """
         super(App, self).build_arg_parser()
-        # self.parser.add_argument('-a', '--agents', dest='agents', action='store_true', help="include agents")
+
+        self.parser.add_argument('-q', '--quiet', action='store_true', help="don't show upload progress")
+
+        self.parser.add_argument('--push', action='store_true', help="copy the uploaded files to agents")
+        self.parser.add_argument('-a', '--agents', dest='agent_ids', metavar='AGENT_IDS',
+                                 type=lambda value: [agent_id for agent_id in value.split(",") if agent_id],
+                                 help="push to the given comma separated agent ids, e.g. -a 12,13 (default all agents)")
+        self.parser.add_argument('--query', action="store",
+                                 help='push to the agents matching a query, e.g. --query="appServerName:Tomcat"')
+        self.parser.add_argument('--destination', action="store",
+                                 help="where the agents write the file (default the name of the file)")
+        self.parser.add_argument('--workers', type=int, default=pyacc.CONCURRENCY,
+                                 help="push to this many agents at once (default %(default)s)")
+        self.parser.add_argument('--rate', type=float,
+                                 help="push to no more than this many agents a second (default no limit)")
+        self.parser.add_argument('--timeout', type=int, default=pyacc.TASK_TIMEOUT,
+                                 help="seconds to wait for the agents to receive the file (default %(default)s)")
+        self.parser.add_argument('--no-wait', dest='wait', action='store_false',
+                                 help="don't wait for the agents to receive the file")
 
         self.parser.add_argument('filenames', metavar='FILE', nargs='+', type=str, help='path to file to push')
 
+    def get_agents(self):
+        """The agents to push to, fetching only their ids"""
+        if self.args.agent_ids:
+            return self.acc.agents_many(self.args.agent_ids)
+
+        request_params = {}
+        if self.args.query:
+            request_params["q"] = self.args.query
+
+        return list(self.acc.agents(compact=("id",), **request_params))
+
+    def push(self, result, agents):
+        """Push the uploaded file to the agents and print the outcome for each of them"""
+        push = self.acc.file_push(result["id"], self.args.destination or result["name"],
+                                  workers=self.args.workers, rate=self.args.rate)
+
+        print("Pushing %s to %d agents" % (result["name"], len(agents)))
+        for push_result in push.submit(agents):
+            pass
+
+        if self.args.wait:
+            for push_result in push.wait(self.args.timeout):
+                if push_result.status != pyacc.TASK_COMPLETED:
+                    print("\t".join([str(push_result.agent.item_id), push_result.status]))
+
+        print(push.report())
+
+        return push.failures()
+
     def main(self):
 
+        if self.args.destination and len(self.args.filenames) > 1:
+            self.parser.error("--destination can only be given with a single file")
+
+        agents = None
+        if self.args.push:
+            agents = self.get_agents()
+            if not agents:
+                print("No agents to push to")
+                sys.exit(1)
+
+        failures = 0
+
         # Upload the given files to the config server
         for filename in self.args.filenames:
-            result = self.acc.upload_file(filename)
+            # The file is streamed from disk, so it can be any size
+            result = self.acc.upload_file(filename, None if self.args.quiet else pyacc.progress_printer(filename))
             print("\t".join([str(result["id"]), result["name"], result["modified"], str(result["size"])]))
 
+            if agents:
+                failures += self.push(result, agents)
+
+        if failures:
+            sys.exit(1)
+
 if __name__ == "__main__":
     App().run()